@@ -0,0 +1,115 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Times the conversion of recorded OParl objects by FieldPlan against the mongoengine round trip save_object
+used before. References are left out on both sides, because they need the database.
+
+usage: python benchmarks/field_plan.py [--rounds 5] path [path ...]
+
+Paths are saved OParl list pages (.json) or raw archive directories (archive/<body id>).
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from mongoengine import ValidationError
+from oparlsync.oparl_download.FieldPlan import FieldPlan, get_field_plan, convert_datetime
+from oparlsync.oparl_download.RawArchive import read_archive
+
+
+def load_objects(paths):
+    objects = []
+    for path in paths:
+        if os.path.isdir(path):
+            for line in read_archive(path):
+                if 'url' not in line and line.get('type') in FieldPlan.oparl_objects:
+                    objects.append((FieldPlan.oparl_objects[line['type']], line['data']))
+            continue
+        with open(path) as page_file:
+            page = json.load(page_file)
+        for object_raw in page.get('data', [page]):
+            object_type = object_raw.get('type', '').split('/')[-1]
+            if object_type in FieldPlan.oparl_objects:
+                objects.append((FieldPlan.oparl_objects[object_type], object_raw))
+    return objects
+
+
+def convert_old(object, object_raw):
+    object_instance = object()
+    for key, value in object_raw.items():
+        if key not in object_instance._fields:
+            continue
+        field_type = type(object_instance._fields[key]).__name__
+        if field_type == 'ReferenceField' or (
+                field_type == 'ListField' and type(object_instance._fields[key].field).__name__ == 'ReferenceField'):
+            continue
+        if field_type == 'DateTimeField':
+            setattr(object_instance, key, convert_datetime(value))
+        elif key in FieldPlan.renamed_fields:
+            setattr(object_instance, FieldPlan.renamed_fields[key], value)
+        else:
+            setattr(object_instance, key, value)
+    try:
+        object_instance.validate()
+    except ValidationError:
+        pass
+    object_json = json.loads(object_instance.to_json())
+    for field_key in object_json.keys():
+        if type(object_instance._fields[field_key]).__name__ == 'DateTimeField':
+            object_json[field_key] = getattr(object_instance, field_key)
+    return object_json
+
+
+def convert_new(object, object_raw):
+    field_plan = get_field_plan(object)
+    object_json = {}
+    for key, value in object_raw.items():
+        if key not in field_plan.steps or field_plan.steps[key][0] in [FieldPlan.REFERENCE, FieldPlan.LIST_REFERENCE]:
+            continue
+        converted = field_plan.convert_value(key, value)
+        if converted:
+            object_json[converted[0]] = converted[1]
+    field_plan.validate(object_json)
+    return object_json
+
+
+def measure(convert, objects, rounds):
+    best = None
+    for i in range(rounds):
+        start_time = time.perf_counter()
+        for object, object_raw in objects:
+            convert(object, dict(object_raw))
+        duration = time.perf_counter() - start_time
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('paths', nargs='+')
+parser.add_argument('--rounds', type=int, default=5)
+args = parser.parse_args()
+
+objects = load_objects(args.paths)
+if not objects:
+    sys.exit('no OParl objects found')
+old = measure(convert_old, objects, args.rounds)
+new = measure(convert_new, objects, args.rounds)
+print('objects:    %s' % len(objects))
+print('old path:   %s ms (%s us per object)' % (round(old * 1000, 1), round(old * 1000000 / len(objects), 1)))
+print('field plan: %s ms (%s us per object)' % (round(new * 1000, 1), round(new * 1000000 / len(objects), 1)))
+print('speedup:    %sx' % round(old / max(new, 1e-9), 1))
@@ -0,0 +1,106 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+"""
+Seeds a scratch collection with queue jobs and times MongoQueue.next() against it. Prints the query plan of the
+claim, which should be an index scan without a sort stage. The scratch collection is dropped afterwards.
+
+usage: python benchmarks/queue_claim.py [--host localhost] [--port 27017] [--db oparl] [--jobs 100000]
+                                        [--externals 50] [--claims 1000]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import pymongo
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from oparlsync.mongoqueue import MongoQueue
+from oparlsync.mongoqueue.mongoqueue import DEFAULT_INSERT
+
+
+def seed(collection, jobs, externals):
+    # a few externals hold most jobs, like big hosts in the download queue
+    hosts = ['10.0.0.%s' % i for i in range(externals)] + [None]
+    weights = [1 / (i + 1) for i in range(len(hosts))]
+    batch = []
+    for i in range(jobs):
+        job = dict(DEFAULT_INSERT)
+        job['priority'] = 0
+        job['payload'] = {'module': 'download', 'body': 'body-%s' % i}
+        job['external'] = random.choices(hosts, weights)[0]
+        batch.append(job)
+        if len(batch) == 1000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+
+def get_plan(explain):
+    plan = explain['queryPlanner']['winningPlan']
+    # newer servers wrap the plan of the slot based engine
+    plan = plan.get('queryPlan', plan)
+    stages = []
+    while plan:
+        stages.append(plan['stage'] + (' (%s)' % plan['indexName'] if 'indexName' in plan else ''))
+        plan = plan.get('inputStage')
+    return ' <- '.join(stages)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', default='localhost')
+parser.add_argument('--port', type=int, default=27017)
+parser.add_argument('--db', default='oparl')
+parser.add_argument('--jobs', type=int, default=100000)
+parser.add_argument('--externals', type=int, default=50)
+parser.add_argument('--claims', type=int, default=1000)
+args = parser.parse_args()
+
+client = pymongo.MongoClient(host=args.host, port=args.port, connect=False)
+collection = client[args.db]['queue_benchmark_%s' % os.getpid()]
+try:
+    start_time = time.perf_counter()
+    seed(collection, args.jobs, args.externals)
+    print('seeded %s jobs in %s s' % (args.jobs, round(time.perf_counter() - start_time, 1)))
+    queue = MongoQueue(collection, consumer_id='benchmark', max_per_external=2)
+
+    durations = []
+    for i in range(args.claims):
+        start_time = time.perf_counter()
+        job = queue.next()
+        durations.append(time.perf_counter() - start_time)
+        if not job:
+            break
+        job.complete()
+    durations.sort()
+    print('claims:  %s' % len(durations))
+    print('average: %s ms' % round(sum(durations) * 1000 / len(durations), 2))
+    for percentile in [50, 95, 99]:
+        print('p%s:     %s ms' % (percentile, round(durations[int(len(durations) * percentile / 100)] * 1000, 2)))
+    print('max:     %s ms' % round(durations[-1] * 1000, 2))
+
+    # the biggest externals skipped, as if they were saturated or served recently
+    claim = collection.find({
+        'locked_by': None,
+        'locked_at': None,
+        'attempts': {'$lt': queue.max_attempts},
+        'external': {'$nin': ['10.0.0.0', '10.0.0.1']}
+    }).sort([('priority', pymongo.DESCENDING), ('_id', pymongo.ASCENDING)]).limit(1)
+    explain = claim.explain()
+    print('claim: %s' % get_plan(explain))
+    print('keys examined: %s, documents examined: %s' % (
+        explain['executionStats']['totalKeysExamined'], explain['executionStats']['totalDocsExamined']))
+finally:
+    collection.drop()
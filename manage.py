@@ -16,7 +16,7 @@ from oparlsync import OparlSync
 
 daemon_choices = ['start', 'start-foreground', 'stop', 'status']
 queue_choices = ['add', 'clear', 'list', 'stats']
-module_choices = ['download', 'backref', 'elastic', 'thumbnails', 'fulltext', 'georef', 'sitemap', 'misc', 'worker']
+module_choices = ['download', 'download-many', 'replay', 'files', 'backref', 'elastic', 'thumbnails', 'fulltext', 'georef', 'sitemap', 'misc', 'worker']
 worker_region_choices = ['region-download', 'region-elastic', 'sync-region', 'sync-regions']
 worker_body_choices = ['remove-body', 'sync-bodies', 'sync-body', 'remove-locations', 'reset-georef', 'reset-lastsync']
 worker_misc_choices = ['migrate-ids', 'fix-oparl-11', 'sitemap-master']
@@ -58,6 +58,36 @@ if len(args) > 1:
                             metavar='1970-01-01'
                         )
                     parser.add_argument('--nonext')
+            elif args[2] == 'list':
+                parser.add_argument(
+                    '-m',
+                    '--module',
+                    choices=module_choices
+                )
+                parser.add_argument(
+                    '-b',
+                    '--body'
+                )
+                parser.add_argument(
+                    '--status',
+                    choices=['available', 'locked', 'error']
+                )
+                parser.add_argument(
+                    '-p',
+                    '--pool',
+                    choices=['network', 'local']
+                )
+                parser.add_argument(
+                    '-l',
+                    '--limit',
+                    type=int,
+                    default=50
+                )
+                parser.add_argument(
+                    '--skip',
+                    type=int,
+                    default=0
+                )
             elif args[2] == 'clear':
                 parser.add_argument(
                     '-f',
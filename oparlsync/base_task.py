@@ -11,25 +11,18 @@ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
 """
 
 import os
-import sys
-import json
 import time
 import yaml
 import logging
-import pymongo
 import smtplib
 import requests
-import mongoengine
 import subprocess
 from copy import deepcopy
-from minio import Minio
-from minio.error import NoSuchBucketPolicy
-from elasticsearch import Elasticsearch
-from minio.error import (ResponseError, BucketAlreadyOwnedByYou, BucketAlreadyExists, NoSuchKey)
-from urllib3.exceptions import MaxRetryError, ClosedPoolError
-from mongoengine.connection import disconnect as mongoengine_disconnect
+from minio.error import NoSuchKey
 
 from .config import get_config
+from .connections import get_mongodb, get_s3, get_elasticsearch
+from .mongoqueue import Heartbeat
 
 
 class BaseTask():
@@ -37,10 +30,19 @@ class BaseTask():
     body_id = None
     services = []
 
-    def __init__(self):
-        self.config = get_config(os.getenv('APPLICATION_MODE', 'DEVELOPMENT'))()
-        self.init_logging()
-        self.init_db()
+    def __init__(self, shared=None):
+        if shared:
+            # tasks running inside another task use its config, logging and connections
+            self.config = shared.config
+            self.datalog = shared.datalog
+            self.db_raw_client = shared.db_raw_client
+            self.db_raw = shared.db_raw
+            self.s3 = shared.s3
+            self.es = shared.es
+        else:
+            self.config = get_config(os.getenv('APPLICATION_MODE', 'DEVELOPMENT'))()
+            self.init_logging()
+            self.init_db()
         self.default_config = {
             "id": "",
             "rgs": "",
@@ -78,115 +80,29 @@ class BaseTask():
         self.datalog.addHandler(datalog_stream_handler)
 
     def init_db(self):
+        # connections are opened once per process and shared by all tasks running in it
         if 'mongodb' in self.services:
-            mongoengine.connect(
-                db=self.config.MONGO_DB_NAME,
-                host=self.config.MONGO_DB_HOST,
-                port=self.config.MONGO_DB_PORT,
-                connect=False
-            )
-            try:
-                self.db_raw_client = pymongo.MongoClient(
-                    host=self.config.MONGO_DB_HOST,
-                    port=self.config.MONGO_DB_PORT,
-                    connect=False
-                )
-                self.db_raw_client.server_info()
-            except pymongo.errors.ServerSelectionTimeoutError as err:
-                sys.exit('fatal: connection to MongoDB can\'t be established.')
-            self.db_raw = self.db_raw_client[self.config.MONGO_DB_NAME]
+            self.db_raw_client, self.db_raw = get_mongodb(self.config)
         self.s3 = None
         if 's3' in self.services:
-            self.s3 = Minio(self.config.S3_ENDPOINT,
-                            access_key=self.config.S3_ACCESS_KEY,
-                            secret_key=self.config.S3_SECRET_KEY,
-                            secure=self.config.S3_SECURE)
-            try:
-                if not self.s3.bucket_exists(self.config.S3_BUCKET):
-                    self.s3.make_bucket(self.config.S3_BUCKET, location=self.config.S3_LOCATION)
-            except (MaxRetryError, ResponseError) as err:
-                sys.exit('fatal: connection to Minio can\'t be established.')
-            # Policies
-            needs_policy_update = False
-            try:
-                policies = json.loads(self.s3.get_bucket_policy(self.config.S3_BUCKET).decode("utf-8"))
-                if self.config.ENABLE_PROCESSING and len(policies['Statement']) == 3:
-                    needs_policy_update = True
-            except NoSuchBucketPolicy:
-                needs_policy_update = True
-            if needs_policy_update:
-                policies = [
-                    {
-                        'Effect': 'Allow',
-                        'Principal': {'AWS': ['*']},
-                        'Action': ['s3:GetBucketLocation'],
-                        'Resource': ['arn:aws:s3:::%s' % self.config.S3_BUCKET]
-                    },
-                    {
-                        'Effect': 'Allow',
-                        'Principal': {'AWS': ['*']},
-                        'Action': ['s3:ListBucket'],
-                        'Resource': ['arn:aws:s3:::%s' % self.config.S3_BUCKET],
-                        'Condition': {
-                            'StringEquals': {
-                                's3:prefix': ['files']
-                            }
-                        }
-                    },
-                    {
-                        'Effect': 'Allow',
-                        'Principal': {'AWS': ['*']},
-                        'Action': ['s3:GetObject'],
-                        'Resource': ['arn:aws:s3:::%s/files*' % self.config.S3_BUCKET]
-                    }
-                ]
-                if self.config.ENABLE_PROCESSING:
-                    policies.append(
-                        {
-                            'Effect': 'Allow',
-                            'Principal': {'AWS': ['*']},
-                            'Action': ['s3:ListBucket'],
-                            'Resource': ['arn:aws:s3:::%s' % self.config.S3_BUCKET],
-                            'Condition': {
-                                'StringEquals': {
-                                    's3:prefix': ['file-thumbnails']
-                                }
-                            }
-                        }
-                    )
-                    policies.append(
-                        {
-                            'Effect': 'Allow',
-                            'Principal': {'AWS': ['*']},
-                            'Action': ['s3:GetObject'],
-                            'Resource': ['arn:aws:s3:::%s/file-thumbnails*' % self.config.S3_BUCKET]
-                        }
-                    )
-                self.s3.set_bucket_policy(
-                    self.config.S3_BUCKET,
-                    json.dumps({
-                        'Version': '2012-10-17',
-                        'Statement': policies
-                    })
-                )
+            self.s3 = get_s3(self.config)
         self.es = None
         if 'elasticsearch' in self.services:
-            self.es = Elasticsearch(
-                self.config.ES_HOSTS
-            )
+            self.es = get_elasticsearch(self.config)
 
     def close(self):
         self.close_connections()
         self.close_logging()
 
     def close_connections(self):
-        self.db_raw_client.close()
+        """
+        Intentionally closes nothing: the connections belong to the process and are reused by its next task.
+        They are closed by connections.close_connections when the worker shuts down.
+        """
         self.db_raw_client = None
-        mongoengine_disconnect()
-        if self.config.ES_ENABLED and self.es:
-            for conn in self.es.transport.connection_pool.connections:
-                conn.pool.close()
-            self.es = None
+        self.db_raw = None
+        self.s3 = None
+        self.es = None
 
     def close_logging(self):
         for handler in self.datalog.handlers:
@@ -208,7 +124,7 @@ class BaseTask():
             try:
                 data = self.s3.get_object(
                     self.config.S3_BUCKET,
-                    "files/%s/%s" % (file.body.id, file.id)
+                    self.get_file_path(file)
                 )
             except NoSuchKey:
                 return False
@@ -217,6 +133,14 @@ class BaseTask():
                     file_data.write(chunk)
             return True
 
+    def get_file_path(self, file):
+        """
+        Files downloaded since content-addressed storage reference their binary by sha512 as blob.
+        """
+        if file.blob:
+            return "files/blobs/%s" % file.blob
+        return "files/%s/%s" % (file.body.id, file.id)
+
     def execute(self, cmd, body_id):
         new_env = os.environ.copy()
         new_env['XDG_RUNTIME_DIR'] = '/tmp/'
@@ -265,6 +189,11 @@ class BaseTask():
         except FileNotFoundError:
             return None
 
+    def set_progress(self, count=None, stage=None, increment=0):
+        # reported to the queue by the heartbeat of the running job, if there is one
+        if Heartbeat.current:
+            Heartbeat.current.update(count, stage, increment)
+
     def get_region_config(self, region_id):
         filename = self.get_region_config_file(region_id)
         try:
@@ -21,12 +21,14 @@ class BaseConfig:
     LOG_DIR = os.path.abspath(os.path.join(BASE_DIR, os.pardir, 'logs'))
     BODY_DIR = os.path.abspath(os.path.join(BASE_DIR, os.pardir, 'bodies'))
     REGION_DIR = os.path.abspath(os.path.join(BASE_DIR, os.pardir, 'regions'))
+    ARCHIVE_DIR = os.path.abspath(os.path.join(BASE_DIR, os.pardir, 'archive'))
     TMP_DIR = os.path.abspath(os.path.join(BASE_DIR, os.pardir, 'tmp'))
     TMP_FILE_DIR = os.path.abspath(os.path.join(TMP_DIR, 'files'))
     TMP_FULLTEXT_DIR = os.path.abspath(os.path.join(TMP_DIR, 'fulltext'))
     TMP_THUMBNAIL_DIR = os.path.abspath(os.path.join(TMP_DIR, 'thumbnails'))
     TMP_OSM_DIR = os.path.abspath(os.path.join(TMP_DIR, 'osm'))
     TMP_REGION_DIR = os.path.abspath(os.path.join(TMP_DIR, 'region'))
+    TMP_HTTP_CACHE_DIR = os.path.abspath(os.path.join(TMP_DIR, 'http'))
 
     BODY_LIST_MODE = 'blacklist'
     BODY_LIST = []
@@ -44,8 +46,46 @@ class BaseConfig:
     MONGO_DB_NAME = 'oparl'
 
     THREADS_NETWORK_MAX = 4
-    THREADS_LOCAL_MAX = 4
+    THREADS_LOCAL_MAX = os.cpu_count() or 4
+    QUEUE_LOCAL_MODULES = ['thumbnails', 'fulltext', 'georefs']
+    QUEUE_POLL_INTERVAL = 10
+    QUEUE_LEASE_TIME = 300
+    QUEUE_HEARTBEAT_INTERVAL = 60
+    QUEUE_REAPER_INTERVAL = 60
+    QUEUE_HOST_MAX_JOBS = 2
+    QUEUE_HOST_MODULES = ['download', 'files']
+    QUEUE_HOST_CACHE_TIME = 3600
     GET_URL_WAIT_TIME = 0.2
+    OPARL_HOST_MAX_REQUESTS = 2
+    OPARL_PARALLEL_BODIES = 8
+    HTTP_POOL_SIZE = 32
+    OPARL_HTTP_RETRIES = 4
+    HOST_MIN_RATE = 0.2
+    HOST_MAX_RATE = 5
+    HOST_LATENCY_TARGET = 2
+    HOST_CIRCUIT_FAILURES = 10
+    HOST_CIRCUIT_COOLDOWN = 300
+    OPARL_LIST_PREFETCH = 2
+    OPARL_BULK_SIZE = 500
+    OPARL_WARM_CACHE = True
+    OPARL_FINGERPRINT = True
+    OPARL_HTTP_CACHE = True
+    OPARL_HTTP_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+    OPARL_HTTP_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+    OPARL_SPOOL_SIZE = 8 * 1024 * 1024
+    OPARL_CHECKPOINT = True
+    OPARL_CHECKPOINT_MAX_AGE = 3 * 24 * 60 * 60
+    OPARL_SYNC_MAX_FAILURES = 3
+    OPARL_WATERMARK_MARGIN = 15 * 60
+    OPARL_ARCHIVE = False
+    OPARL_ARCHIVE_SEGMENT_SIZE = 10000
+    OPARL_ARCHIVE_MAX_SEGMENTS = 100
+    FILE_DOWNLOAD_THREADS = 4
+    FILE_DOWNLOAD_HOST_MAX_REQUESTS = 2
+    FILE_DOWNLOAD_RETRIES = 3
+    FILE_DOWNLOAD_MAX_ATTEMPTS = 5
+    FILE_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+    FILE_DOWNLOAD_SPOOL_SIZE = 32 * 1024 * 1024
     ENABLE_PROCESSING = True
 
     S3_ENDPOINT = 'localhost:9000'
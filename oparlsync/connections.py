@@ -0,0 +1,178 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import sys
+import json
+import pymongo
+import mongoengine
+from minio import Minio
+from minio.error import NoSuchBucketPolicy, ResponseError
+from elasticsearch import Elasticsearch
+from urllib3.exceptions import MaxRetryError
+from mongoengine import connection as mongoengine_connection
+from mongoengine.connection import disconnect as mongoengine_disconnect
+
+# Connections of this process, shared by all tasks it runs. Forked processes start with an empty registry, but
+# keep knowing that the bucket was set up already.
+connections = {}
+connections_pid = None
+s3_ready = False
+
+
+def get_connections():
+    global connections, connections_pid
+    if connections_pid != os.getpid():
+        # connections of the parent process must not be used after a fork. mongoengine keeps its clients in a
+        # global alias table, which is forgotten without closing, as the sockets belong to the parent.
+        mongoengine_connection._connections.clear()
+        mongoengine_connection._dbs.clear()
+        connections = {}
+        connections_pid = os.getpid()
+    return connections
+
+
+def get_mongodb(config):
+    """
+    Returns the pymongo client and database. mongoengine is connected along with it.
+    """
+    registry = get_connections()
+    if 'mongodb' not in registry:
+        mongoengine.connect(
+            db=config.MONGO_DB_NAME,
+            host=config.MONGO_DB_HOST,
+            port=config.MONGO_DB_PORT,
+            connect=False
+        )
+        try:
+            db_raw_client = pymongo.MongoClient(
+                host=config.MONGO_DB_HOST,
+                port=config.MONGO_DB_PORT,
+                connect=False
+            )
+            db_raw_client.server_info()
+        except pymongo.errors.ServerSelectionTimeoutError as err:
+            sys.exit('fatal: connection to MongoDB can\'t be established.')
+        registry['mongodb'] = (db_raw_client, db_raw_client[config.MONGO_DB_NAME])
+    return registry['mongodb']
+
+
+def get_s3(config):
+    registry = get_connections()
+    if 's3' not in registry:
+        registry['s3'] = Minio(config.S3_ENDPOINT,
+                               access_key=config.S3_ACCESS_KEY,
+                               secret_key=config.S3_SECRET_KEY,
+                               secure=config.S3_SECURE)
+        if not s3_ready:
+            setup_s3(config, registry['s3'])
+    return registry['s3']
+
+
+def get_elasticsearch(config):
+    registry = get_connections()
+    if 'elasticsearch' not in registry:
+        registry['elasticsearch'] = Elasticsearch(config.ES_HOSTS)
+    return registry['elasticsearch']
+
+
+def setup_s3(config, s3=None):
+    """
+    Creates the bucket and its public policies. The daemon runs this once at start, single runs before their
+    first use of S3.
+    """
+    global s3_ready
+    if s3 is None:
+        s3 = Minio(config.S3_ENDPOINT,
+                   access_key=config.S3_ACCESS_KEY,
+                   secret_key=config.S3_SECRET_KEY,
+                   secure=config.S3_SECURE)
+    try:
+        if not s3.bucket_exists(config.S3_BUCKET):
+            s3.make_bucket(config.S3_BUCKET, location=config.S3_LOCATION)
+    except (MaxRetryError, ResponseError) as err:
+        sys.exit('fatal: connection to Minio can\'t be established.')
+    # Policies
+    needs_policy_update = False
+    try:
+        policies = json.loads(s3.get_bucket_policy(config.S3_BUCKET).decode("utf-8"))
+        if config.ENABLE_PROCESSING and len(policies['Statement']) == 3:
+            needs_policy_update = True
+    except NoSuchBucketPolicy:
+        needs_policy_update = True
+    if needs_policy_update:
+        policies = [
+            {
+                'Effect': 'Allow',
+                'Principal': {'AWS': ['*']},
+                'Action': ['s3:GetBucketLocation'],
+                'Resource': ['arn:aws:s3:::%s' % config.S3_BUCKET]
+            },
+            {
+                'Effect': 'Allow',
+                'Principal': {'AWS': ['*']},
+                'Action': ['s3:ListBucket'],
+                'Resource': ['arn:aws:s3:::%s' % config.S3_BUCKET],
+                'Condition': {
+                    'StringEquals': {
+                        's3:prefix': ['files']
+                    }
+                }
+            },
+            {
+                'Effect': 'Allow',
+                'Principal': {'AWS': ['*']},
+                'Action': ['s3:GetObject'],
+                'Resource': ['arn:aws:s3:::%s/files*' % config.S3_BUCKET]
+            }
+        ]
+        if config.ENABLE_PROCESSING:
+            policies.append(
+                {
+                    'Effect': 'Allow',
+                    'Principal': {'AWS': ['*']},
+                    'Action': ['s3:ListBucket'],
+                    'Resource': ['arn:aws:s3:::%s' % config.S3_BUCKET],
+                    'Condition': {
+                        'StringEquals': {
+                            's3:prefix': ['file-thumbnails']
+                        }
+                    }
+                }
+            )
+            policies.append(
+                {
+                    'Effect': 'Allow',
+                    'Principal': {'AWS': ['*']},
+                    'Action': ['s3:GetObject'],
+                    'Resource': ['arn:aws:s3:::%s/file-thumbnails*' % config.S3_BUCKET]
+                }
+            )
+        s3.set_bucket_policy(
+            config.S3_BUCKET,
+            json.dumps({
+                'Version': '2012-10-17',
+                'Statement': policies
+            })
+        )
+    s3_ready = True
+
+
+def close_connections():
+    registry = get_connections()
+    if 'mongodb' in registry:
+        registry['mongodb'][0].close()
+        mongoengine_disconnect()
+    if 'elasticsearch' in registry:
+        for conn in registry['elasticsearch'].transport.connection_pool.connections:
+            conn.pool.close()
+    registry.clear()
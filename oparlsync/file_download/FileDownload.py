@@ -0,0 +1,251 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import time
+import shutil
+import threading
+from ssl import SSLError
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from ..models import Body
+from ..base_task import BaseTask
+from ..oparl_download.HttpSession import get_http_session
+from ..oparl_download.HostLimiter import get_host_limiter, get_retry_delay, get_retry_after
+from .HashingReader import HashingReader
+from minio.error import ResponseError, SignatureDoesNotMatch, NoSuchKey
+from requests.exceptions import RequestException
+from urllib3.exceptions import HTTPError as Urllib3HTTPError, ProtocolError
+
+
+class FileDownload(BaseTask):
+    """
+    Downloads the binaries of all files OparlDownload marked with downloaded = False and stores them at S3.
+    """
+    name = 'FileDownload'
+    services = [
+        'mongodb',
+        's3'
+    ]
+
+    def __init__(self, **kwargs):
+        super().__init__()
+        self.statistics = {
+            'downloaded': 0,
+            'failed': 0,
+            'retries': 0,
+            'deduplicated': 0,
+            'transfer-time': 0,
+            'wait-time': 0
+        }
+        self.statistics_lock = threading.Lock()
+        self.http_session = get_http_session(self.config.HTTP_POOL_SIZE)
+        if self.config.USE_MIRROR:
+            return
+        self.body = Body.objects(uid=kwargs.get('body')).no_cache().first()
+        if not self.body:
+            return
+        self.body_config = self.get_body_config(self.body.uid)
+        if not self.body_config:
+            return
+        self.run()
+
+    def run(self):
+        start_time = time.time()
+        files = list(self.db_raw.file.find(
+            {
+                'body': self.body.id,
+                'downloaded': {'$ne': True},
+                'originalAccessUrl': {'$exists': True},
+                'downloadAttempts': {'$not': {'$gte': self.config.FILE_DOWNLOAD_MAX_ATTEMPTS}}
+            },
+            {
+                'originalAccessUrl': 1,
+                'mimeType': 1,
+                'fileName': 1,
+                'size': 1,
+                'sha1Checksum': 1,
+                'sha512Checksum': 1,
+                'blob': 1
+            }
+        ))
+        self.datalog.info('Body %s: %s files to download' % (self.body.uid, len(files)))
+        with ThreadPoolExecutor(max_workers=self.config.FILE_DOWNLOAD_THREADS) as executor:
+            for count, result in enumerate(executor.map(self.save_file, files), 1):
+                self.set_progress(count, 'files')
+                if count % 100 == 0:
+                    self.datalog.info('Body %s: %s of %s files processed' % (self.body.uid, count, len(files)))
+
+        self.datalog.info('Body %s file download done. Results:' % self.body.uid)
+        self.datalog.info('downloaded:    %s' % self.statistics['downloaded'])
+        self.datalog.info('failed:        %s' % self.statistics['failed'])
+        self.datalog.info('retries:       %s' % self.statistics['retries'])
+        self.datalog.info('deduplicated:  %s' % self.statistics['deduplicated'])
+        self.datalog.info('transfer time: %s s' % round(self.statistics['transfer-time'], 1))
+        self.datalog.info('wait time:     %s s' % round(self.statistics['wait-time'], 1))
+        self.datalog.info('all time:      %s s' % round(time.time() - start_time, 1))
+
+    def save_file(self, file_json):
+        mime_type = file_json.get('mimeType')
+        file_name = file_json.get('fileName')
+        if not file_name:
+            splitted_file_name = file_json['originalAccessUrl'].split('/')
+            if len(splitted_file_name):
+                if len(splitted_file_name[-1]) > 3 and '.' in splitted_file_name[-1]:
+                    file_name = splitted_file_name[-1]
+        if not file_name or not mime_type:
+            self.datalog.warn('No file name or no mime type avaliable at File %s from Body %s' % (
+                file_json['_id'], self.body.uid))
+            file_name = None
+
+        object_json_update = None
+        if file_name:
+            object_json_update = self.reuse_blob(file_json)
+        if object_json_update is None:
+            object_json_update = self.download_file(file_json, file_name, mime_type)
+        if object_json_update is None:
+            self.datalog.warn('No valid file could be downloaded at File %s from Body %s' % (file_json['_id'], self.body.uid))
+            self.db_raw.file.update_one({'_id': file_json['_id']}, {'$inc': {'downloadAttempts': 1}})
+            self.count('failed')
+            return False
+        for key in ['size', 'sha1Checksum', 'sha512Checksum']:
+            if key in file_json:
+                object_json_update.pop(key, None)
+        if object_json_update.get('downloaded'):
+            self.count('downloaded')
+        else:
+            # retrying doesn't help here, the file is tried again as soon as it is changed at the RIS
+            self.count('failed')
+            object_json_update['downloadAttempts'] = self.config.FILE_DOWNLOAD_MAX_ATTEMPTS
+        object_json = {'$set': object_json_update}
+        if object_json_update.get('blob') and object_json_update['blob'] != file_json.get('blob'):
+            # new or changed content, so thumbnails and fulltext have to be generated again
+            object_json['$unset'] = {'thumbnailStatus': 1, 'textStatus': 1}
+        self.db_raw.file.update_one(
+            {'_id': file_json['_id']},
+            object_json
+        )
+        return object_json_update.get('downloaded', False)
+
+    def download_file(self, file_json, file_name, mime_type):
+        """
+        Streams the file to S3. Connection errors, 429 and 5xx are retried with jittered backoff.
+        """
+        url = file_json['originalAccessUrl']
+        host_limiter = get_host_limiter(
+            url,
+            self.config.FILE_DOWNLOAD_HOST_MAX_REQUESTS,
+            self.body_config.get('wait_time', self.config.GET_URL_WAIT_TIME),
+            self.config,
+            self.body_config.get('max_rate')
+        )
+        for attempt in range(self.config.FILE_DOWNLOAD_RETRIES + 1):
+            if attempt:
+                self.count('retries')
+                time.sleep(get_retry_delay(attempt))
+            self.count('wait-time', host_limiter.acquire())
+            start_time = time.time()
+            try:
+                status_code, retry_after, object_json_update = self.transfer_file(file_json, file_name, mime_type)
+            finally:
+                host_limiter.release()
+            if status_code and status_code != 429 and status_code < 500:
+                host_limiter.success(time.time() - start_time)
+                return object_json_update if status_code == 200 else None
+            if host_limiter.failure(retry_after):
+                self.datalog.warn('host of %s paused after repeated failures' % url)
+        return None
+
+    def transfer_file(self, file_json, file_name, mime_type):
+        """
+        Spools one download through the checksum calculation and returns the http status code, the Retry-After
+        seconds and the values to update at the file. Binaries are stored once per content at
+        files/blobs/<sha512>, so the upload is skipped if the blob exists already. The spool spills to disk for
+        big files only. The status code is None if the transfer failed.
+        """
+        start_time = time.time()
+        try:
+            r = self.http_session.get(file_json['originalAccessUrl'], stream=True, timeout=300)
+            if r.status_code != 200:
+                return r.status_code, get_retry_after(r), None
+            r.raw.decode_content = True
+            reader = HashingReader(r.raw)
+            length = None
+            if r.headers.get('Content-Length', '').isdigit() and not r.headers.get('Content-Encoding'):
+                length = int(r.headers['Content-Length'])
+            object_json_update = {}
+            with SpooledTemporaryFile(max_size=self.config.FILE_DOWNLOAD_SPOOL_SIZE, dir=self.config.TMP_FILE_DIR) as spool:
+                try:
+                    shutil.copyfileobj(reader, spool, self.config.FILE_DOWNLOAD_CHUNK_SIZE)
+                except ProtocolError:
+                    # some RIS close chunked responses unclean, truncated responses are caught by the length check
+                    pass
+                if length is not None and reader.size != length:
+                    # the connection broke before the announced length was received
+                    return None, None, None
+                if file_name:
+                    blob = reader.sha512.hexdigest()
+                    if self.blob_exists(blob):
+                        self.count('deduplicated')
+                    else:
+                        spool.seek(0)
+                        self.put_file(blob, file_name, mime_type, spool, reader.size)
+                    object_json_update['downloaded'] = True
+                    object_json_update['blob'] = blob
+        except (SSLError, ConnectionResetError, RequestException, Urllib3HTTPError):
+            return None, None, None
+        except (ResponseError, SignatureDoesNotMatch):
+            self.datalog.warn('Critical error saving file from File %s from Body %s' % (file_json['_id'], self.body.uid))
+            return None, None, None
+        finally:
+            self.count('transfer-time', time.time() - start_time)
+        object_json_update['size'] = reader.size
+        object_json_update['sha1Checksum'] = reader.sha1.hexdigest()
+        object_json_update['sha512Checksum'] = reader.sha512.hexdigest()
+        if file_name:
+            self.datalog.debug('Binary file at File %s from Body %s saved successfully.' % (file_json['_id'], self.body.uid))
+        return 200, None, object_json_update
+
+    def reuse_blob(self, file_json):
+        """
+        Skips the download if the RIS tells a sha512 checksum which another file has as blob already. A checksum
+        equal to the file's own blob may be the one calculated at an earlier download, so it isn't trusted.
+        """
+        checksum = (file_json.get('sha512Checksum') or '').lower()
+        if not checksum or checksum == file_json.get('blob'):
+            return None
+        if not self.db_raw.file.find_one({'blob': checksum, 'downloaded': True}, {'_id': 1}):
+            return None
+        self.count('deduplicated')
+        return {'downloaded': True, 'blob': checksum}
+
+    def blob_exists(self, blob):
+        try:
+            self.s3.stat_object(self.config.S3_BUCKET, 'files/blobs/%s' % blob)
+        except NoSuchKey:
+            return False
+        return True
+
+    def put_file(self, blob, file_name, mime_type, data, length):
+        self.s3.put_object(
+            self.config.S3_BUCKET,
+            'files/blobs/%s' % blob,
+            data,
+            length,
+            content_type=mime_type,
+            metadata={
+                'Content-Disposition': 'filename=%s' % file_name
+            }
+        )
+
+    def count(self, key, value=1):
+        with self.statistics_lock:
+            self.statistics[key] += value
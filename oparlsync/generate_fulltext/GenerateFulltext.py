@@ -32,6 +32,7 @@ class GenerateFulltext(BaseTask):
             'wrong-mimetype': 0,
             'file-missing': 0,
             'no-text': 0,
+            'reused': 0,
             'successful': 0
         }
         if not self.config.ENABLE_PROCESSING:
@@ -43,8 +44,21 @@ class GenerateFulltext(BaseTask):
         files = File.objects(textStatus__exists=False, body=self.body.id).timeout(False).no_cache().all()
         for file in files:
             self.datalog.info('processing file %s' % file.id)
+            self.set_progress(increment=1, stage='files')
             file.modified = datetime.datetime.now()
             file.textGenerated = datetime.datetime.now()
+
+            # the text of binaries we know already is copied
+            if file.blob:
+                sibling = File.objects(blob=file.blob, textStatus__in=['successful', 'no-text'], id__ne=file.id).only(
+                    'text', 'textStatus').no_cache().first()
+                if sibling:
+                    self.statistics['reused'] += 1
+                    file.text = sibling.text
+                    file.textStatus = sibling.textStatus
+                    file.save()
+                    continue
+
             # get file
             file_path = os.path.join(self.config.TMP_FULLTEXT_DIR, str(file.id))
             if not self.get_file(file, file_path):
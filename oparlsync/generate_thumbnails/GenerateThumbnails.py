@@ -32,6 +32,7 @@ class GenerateThumbnails(BaseTask):
         self.statistics = {
             'wrong-mimetype': 0,
             'file-missing': 0,
+            'reused': 0,
             'successful': 0
         }
         if not self.config.ENABLE_PROCESSING:
@@ -52,9 +53,15 @@ class GenerateThumbnails(BaseTask):
             if not file:
                 break
             self.datalog.info('processing file %s' % file.id)
+            self.set_progress(increment=1, stage='files')
             file.modified = datetime.datetime.now()
             file.thumbnailGenerated = datetime.datetime.now()
 
+            # thumbnails of binaries we know already are shared
+            if self.reuse_thumbnails(file):
+                self.statistics['reused'] += 1
+                continue
+
             # get file
             file_path =  os.path.join(self.config.TMP_THUMBNAIL_DIR, str(file.id))
             if not self.get_file(file, file_path):
@@ -140,7 +147,7 @@ class GenerateThumbnails(BaseTask):
                     try:
                         self.s3.fput_object(
                             self.config.S3_BUCKET,
-                            "file-thumbnails/%s/%s/%s/%s" % (self.body.id, str(file.id), str(size), out_file),
+                            "%s/%s/%s" % (self.get_thumbnail_path(file), str(size), out_file),
                             os.path.join(out_folder, str(size), out_file),
                             'image/jpeg'
                         )
@@ -166,6 +173,28 @@ class GenerateThumbnails(BaseTask):
             shutil.rmtree(max_folder)
             shutil.rmtree(out_folder)
 
+    def get_thumbnail_path(self, file):
+        if file.blob:
+            return "file-thumbnails/blobs/%s" % file.blob
+        return "file-thumbnails/%s/%s" % (self.body.id, str(file.id))
+
+    def reuse_thumbnails(self, file):
+        """
+        Copies the thumbnail data of another file with the same blob, the images are stored per blob.
+        """
+        if not file.blob:
+            return False
+        sibling = File.objects(blob=file.blob, thumbnailStatus='successful', id__ne=file.id).no_cache().first()
+        if not sibling:
+            return False
+        file.thumbnail = sibling.thumbnail
+        file.pages = sibling.pages
+        file.thumbnailStatus = 'successful'
+        file.thumbnailsGenerated = datetime.datetime.now()
+        file.modified = datetime.datetime.now()
+        file.save()
+        return True
+
     def conditional_to_greyscale(self, image):
         """
         Convert the image to greyscale if the image information
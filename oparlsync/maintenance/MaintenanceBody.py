@@ -58,7 +58,9 @@ class MaintenanceBody:
 
         object_json = {
             '$unset': {
-                'lastSync': ''
+                'lastSync': '',
+                'syncWatermarks': '',
+                'syncCheckpoint': ''
             }
         }
         self.db_raw.body.update_many(
@@ -1,5 +1,6 @@
 
-__all__ = ['MongoQueue', 'Job', 'MongoLock', 'lock']
+__all__ = ['MongoQueue', 'Job', 'Heartbeat', 'MongoLock', 'lock']
 
 from .mongoqueue import MongoQueue, Job
+from .heartbeat import Heartbeat
 from .lock import MongoLock, lock
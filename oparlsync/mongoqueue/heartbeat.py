@@ -0,0 +1,55 @@
+import threading
+
+from pymongo import errors
+
+
+class Heartbeat(threading.Thread):
+    """Renews the lease of a running job every interval seconds and stores
+    its progress counter and current stage. Tasks report their progress
+    through Heartbeat.current, the heartbeat of the job running in this
+    process.
+    """
+
+    current = None
+
+    def __init__(self, job, interval=60):
+        super(Heartbeat, self).__init__(daemon=True)
+        self.job = job
+        self.interval = interval
+        self.count = 0
+        self.stage = None
+        self.lost = False
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def update(self, count=None, stage=None, increment=0):
+        with self._lock:
+            if count is not None:
+                self.count = count
+            self.count += increment
+            if stage is not None:
+                self.stage = stage
+
+    def beat(self):
+        with self._lock:
+            count, stage = self.count, self.stage
+        try:
+            if self.job.progress(count, stage) is None:
+                # the lease expired and the job was handed out again
+                self.lost = True
+        except errors.PyMongoError:
+            pass
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.beat()
+
+    def start(self):
+        Heartbeat.current = self
+        super(Heartbeat, self).start()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        if Heartbeat.current is self:
+            Heartbeat.current = None
@@ -13,9 +13,12 @@
 #   limitations under the License.
 
 
+import time
 import pymongo
 
+from collections import deque
 from datetime import datetime, timedelta
+from pymongo import errors, CursorType
 import traceback
 
 
@@ -31,13 +34,104 @@ class MongoQueue(object):
     """A queue class
     """
 
-    def __init__(self, collection, consumer_id, timeout=300, max_attempts=3):
-        """
+    def __init__(self, collection, consumer_id, timeout=300, max_attempts=3, notifications=None,
+                 max_per_external=1, unique_keys=None, min_keys=None, match_keys=None, recent_externals=4):
+        """notifications is an optional collection which is used as capped
+        collection to wake up waiting consumers as soon as a job is put.
+        max_per_external is the number of jobs of one external which may
+        run at the same time. The last recent_externals externals served are
+        passed over as long as other jobs are waiting. unique_keys are
+        payload keys identifying a job: a job put while an equal one is
+        waiting is merged into it, keeping the lowest value of the payload's
+        min_keys or none if one of them has none. match_keys are optional payload keys which have to be
+        equal or missing at both jobs. The run of a merged job is added to
+        the payload's runs.
         """
         self.collection = collection
         self.consumer_id = consumer_id
         self.timeout = timeout
         self.max_attempts = max_attempts
+        self.max_per_external = max_per_external
+        self.unique_keys = unique_keys or []
+        self.min_keys = min_keys or []
+        self.match_keys = match_keys or []
+        self.notifications = notifications
+        self.notification_cursor = None
+        self.recent_externals = deque(maxlen=recent_externals)
+        self.ensure_indexes()
+        if self.notifications is not None:
+            self.init_notifications()
+
+    def ensure_indexes(self):
+        """The claim index serves the claim query with its priority sort
+        (equality, sort, range), the running externals, which are the jobs
+        with locked_by set, and stale locks.
+        """
+        self.collection.create_index([
+            ("locked_by", pymongo.ASCENDING),
+            ("locked_at", pymongo.ASCENDING),
+            ("priority", pymongo.DESCENDING),
+            ("_id", pymongo.ASCENDING),
+            ("attempts", pymongo.ASCENDING),
+            ("external", pymongo.ASCENDING)
+        ], name="claim")
+        if self.unique_keys:
+            # serves coalescing jobs when they are put
+            self.collection.create_index(
+                [("payload.%s" % key, pymongo.ASCENDING) for key in self.unique_keys] + [
+                    ("locked_by", pymongo.ASCENDING),
+                    ("locked_at", pymongo.ASCENDING)
+                ], name="coalesce")
+
+    def init_notifications(self):
+        try:
+            self.notifications.database.create_collection(
+                self.notifications.name,
+                capped=True,
+                size=1024 * 1024,
+                max=1000
+            )
+        except errors.CollectionInvalid:
+            pass
+        # a tailable cursor on an empty collection dies at once
+        if not self.notifications.find_one():
+            self.notify()
+
+    def notify(self):
+        """Wake up all consumers waiting for jobs.
+        """
+        if self.notifications is not None:
+            self.notifications.insert({"created": datetime.now()})
+
+    def wait(self, timeout, stop=None):
+        """Block until jobs might be available, but at most timeout
+        seconds. Returns True if woken up by a notification. stop is an
+        optional callable which ends waiting early.
+        """
+        if self.notifications is None:
+            time.sleep(timeout)
+            return False
+        deadline = time.time() + timeout
+        try:
+            if self.notification_cursor is None or not self.notification_cursor.alive:
+                last = list(self.notifications.find().sort('$natural', pymongo.DESCENDING).limit(1))
+                self.notification_cursor = self.notifications.find(
+                    {"_id": {"$gt": last[0]['_id']}} if last else {},
+                    cursor_type=CursorType.TAILABLE_AWAIT
+                ).max_await_time_ms(1000)
+            while time.time() < deadline and not (stop and stop()):
+                try:
+                    self.notification_cursor.next()
+                    return True
+                except StopIteration:
+                    if not self.notification_cursor.alive:
+                        break
+        except errors.PyMongoError:
+            self.notification_cursor = None
+        remaining = deadline - time.time()
+        if remaining > 0 and not (stop and stop()):
+            time.sleep(min(remaining, 1))
+        return False
 
     def close(self):
         """Close the in memory queue connection.
@@ -61,29 +155,37 @@ class MongoQueue(object):
         return self.collection.count()
 
     def repair(self):
-        """Clear out stale locks.
+        """Clear out stale locks, which are locks not renewed for timeout
+        seconds. Returns the number of jobs put back into the queue.
 
         Increments per job attempt counter.
         """
-        self.collection.find_and_modify(
-            query={
+        result = self.collection.update_many(
+            {
                 "locked_by": {"$ne": None},
                 "locked_at": {
-                    "$lt": datetime.now() - timedelta(self.timeout)
+                    "$lt": datetime.now() - timedelta(seconds=self.timeout)
                 }
             },
-            update={
-                "$set": {"locked_by": None, "locked_at": None},
+            {
+                "$set": {"locked_by": None, "locked_at": None, "last_error": "lease expired"},
                 "$inc": {"attempts": 1}
             }
         )
+        if result.modified_count:
+            self.notify()
+        return result.modified_count
 
     def get_running_externals(self):
-        externals = []
-        for job in self.collection.find():
-            if 'external' in job and job['locked_by'] is not None and job['locked_at'] is not None:
-                if job['external']:
-                    externals.append(job['external'])
+        """Number of locked jobs per external. Covered by the claim index,
+        so only the running jobs are read.
+        """
+        externals = {}
+        for job in self.collection.find(
+                {"locked_by": {"$ne": None}},
+                {"_id": 0, "external": 1}).hint("claim"):
+            if job.get('external'):
+                externals[job['external']] = externals.get(job['external'], 0) + 1
         return externals
 
     def drop_max_attempts(self):
@@ -96,36 +198,102 @@ class MongoQueue(object):
     def put(self, payload, external=None, priority=0):
         """Place a job into the queue
         """
+        if self.unique_keys and all(key in payload for key in self.unique_keys):
+            job = self.coalesce(payload, external, priority)
+            if job:
+                return job['_id']
         job = dict(DEFAULT_INSERT)
         job['priority'] = priority
         job['payload'] = payload
         job['external'] = external
-        return self.collection.insert(job)
+        job_id = self.collection.insert(job)
+        self.notify()
+        return job_id
+
+    def coalesce(self, payload, external=None, priority=0):
+        """Merge the payload into a waiting job with the same unique keys.
+        The job keeps the higher priority and the lowest min_keys values.
+        A min_key missing at either job is unset, as it stands for no
+        bound at all. Returns None if there is no such job. Served by the
+        coalesce index.
+        """
+        query = {
+            "locked_by": None,
+            "locked_at": None,
+            "attempts": {"$lt": self.max_attempts}
+        }
+        for key in self.unique_keys:
+            query['payload.%s' % key] = payload[key]
+        for key in self.match_keys:
+            query['payload.%s' % key] = payload[key] if key in payload else {"$exists": False}
+        present = [key for key in self.min_keys if payload.get(key) is not None]
+        missing = [key for key in self.min_keys if payload.get(key) is None]
+        # first a job having all min_keys of the payload, otherwise any job, unsetting them
+        for both in ([True, False] if present else [False]):
+            job_query = dict(query)
+            update = {
+                "$max": {"priority": priority},
+                "$inc": {"coalesced": 1}
+            }
+            if both:
+                for key in present:
+                    job_query['payload.%s' % key] = {"$exists": True}
+                    update.setdefault("$min", {})['payload.%s' % key] = payload[key]
+            unset = missing if both else missing + present
+            if unset:
+                update["$unset"] = dict(('payload.%s' % key, 1) for key in unset)
+            if external is not None:
+                update["$set"] = {"external": external}
+            if payload.get('run'):
+                update["$addToSet"] = {"payload.runs": payload['run']}
+            job = self.collection.find_and_modify(
+                query=job_query,
+                update=update,
+                sort=[('_id', pymongo.ASCENDING)],
+                new=1
+            )
+            if job:
+                return job
+        return None
 
     def next(self):
-        print(self.get_running_externals())
-        return self._wrap_one(self.collection.find_and_modify(
-            query={
-                "locked_by": None,
-                "locked_at": None,
-                "attempts": {
-                    "$lt": self.max_attempts
+        """Claim the next job, the one with the highest priority and then
+        the oldest. Externals with max_per_external running jobs are
+        skipped, and so are the externals served by this consumer most
+        recently, so many jobs of one external can't starve the others.
+        Only if nothing else is waiting the recent externals are claimed.
+        The claim is a single find_and_modify on the claim index.
+        """
+        running = self.get_running_externals()
+        saturated = [external for external, count in running.items() if count >= self.max_per_external]
+        for skipped in [saturated + [external for external in self.recent_externals if external not in saturated],
+                        saturated]:
+            job = self.collection.find_and_modify(
+                query={
+                    "locked_by": None,
+                    "locked_at": None,
+                    "attempts": {"$lt": self.max_attempts},
+                    "external": {"$nin": skipped}
                 },
-                "external": {
-                    "$nin": self.get_running_externals()
-                }
-
-            },
-            update={
-                "$set": {
-                    "locked_by": self.consumer_id,
-                    "locked_at": datetime.now()
-                }
-            },
-            sort=[('priority', pymongo.DESCENDING)],
-            new=1,
-            limit=1
-        ))
+                update={
+                    "$set": {
+                        "locked_by": self.consumer_id,
+                        "locked_at": datetime.now(),
+                        "started_at": datetime.now(),
+                        "progress": 0,
+                        "stage": None
+                    }
+                },
+                sort=[('priority', pymongo.DESCENDING), ('_id', pymongo.ASCENDING)],
+                new=1
+            )
+            if job:
+                if job.get('external') is not None:
+                    self.recent_externals.append(job['external'])
+                return Job(self, job)
+            if len(skipped) == len(saturated):
+                break
+        return None
 
     def _jobs(self):
         return self.collection.find(
@@ -140,47 +308,102 @@ class MongoQueue(object):
     def _wrap_one(self, data):
         return data and Job(self, data) or None
 
-    def stats(self):
-        """Get statistics on the queue.
-
+    def _status(self):
+        """Aggregation expression classifying a job like stats did before.
+        """
+        return {"$cond": [
+            {"$ne": [{"$ifNull": ["$locked_by", None]}, None]},
+            "locked",
+            {"$cond": [{"$gte": ["$attempts", self.max_attempts]}, "error", "available"]}
+        ]}
+
+    def _filter(self, status=None, module=None, body=None):
+        query = {}
+        if status == 'locked':
+            query['locked_by'] = {"$ne": None}
+        elif status == 'error':
+            query['locked_by'] = None
+            query['attempts'] = {"$gte": self.max_attempts}
+        elif status == 'available':
+            query['locked_by'] = None
+            query['attempts'] = {"$lt": self.max_attempts}
+        if module:
+            query['payload.module'] = module
+        if body:
+            # older jobs carry the body as body_id
+            query['$or'] = [{"payload.body": body}, {"payload.body_id": body}]
+        return query
+
+    def stats(self, group_by=None):
+        """Get statistics on the queue. Counting is done by MongoDB, so only
+        one document per group is transferred. group_by is an optional list
+        of module and body, which returns a list of groups with status,
+        count and the oldest job instead of the totals.
         """
+        group = {"status": self._status()}
+        for field in group_by or []:
+            if field == 'module':
+                group['module'] = "$payload.module"
+            elif field == 'body':
+                group['body'] = {"$ifNull": ["$payload.body", "$payload.body_id"]}
+        groups = []
+        for result in self.collection.aggregate([
+                {"$group": {
+                    "_id": group,
+                    "count": {"$sum": 1},
+                    "coalesced": {"$sum": "$coalesced"},
+                    "oldest": {"$min": "$_id"}}},
+                {"$sort": {"_id": 1}}]):
+            item = dict(result['_id'])
+            item['count'] = result['count']
+            item['coalesced'] = result['coalesced']
+            # the ObjectId holds the time the job was put
+            item['oldest'] = result['oldest'].generation_time
+            groups.append(item)
+        if group_by:
+            return groups
         stats = {
             "available": 0,
             "locked": 0,
             "errors": 0,
-            "total": 0
+            "total": 0,
+            "coalesced": 0,
+            "oldest": None
         }
-        items = []
-        for job in self.collection.find():
-            item = job['payload']
-            if job['locked_by'] != None:
-                stats['locked'] += 1
-                item['status'] = 'locked'
-            elif job['attempts'] > self.max_attempts:
-                stats['errors'] += 1
-                item['status'] = 'error'
-            else:
-                stats['available'] += 1
-                item['status'] = 'available'
-            stats['total'] += 1
-            items.append(item)
+        for item in groups:
+            stats['errors' if item['status'] == 'error' else item['status']] += item['count']
+            stats['total'] += item['count']
+            stats['coalesced'] += item['coalesced']
+            if item['status'] == 'available':
+                stats['oldest'] = item['oldest']
         return stats
 
-    def details(self):
-        """Get details on the queue.
-
+    def details(self, status=None, module=None, body=None, skip=0, limit=0):
+        """Get details on the queue. Jobs are streamed in the order they are
+        claimed, filtered and paginated by MongoDB.
         """
-        items = []
-        for job in self.collection.find():
+        cursor = self.collection.find(
+            self._filter(status, module, body),
+            {"payload": 1, "locked_by": 1, "locked_at": 1, "attempts": 1, "priority": 1,
+             "started_at": 1, "progress": 1, "stage": 1}
+        ).sort([("priority", pymongo.DESCENDING), ("_id", pymongo.ASCENDING)]).skip(skip).limit(limit).batch_size(100)
+        for job in cursor:
             item = job['payload']
-            if job['locked_by'] != None:
+            if job['locked_by'] is not None:
                 item['status'] = 'locked'
-            elif job['attempts'] > self.max_attempts:
+            elif job['attempts'] >= self.max_attempts:
                 item['status'] = 'error'
             else:
                 item['status'] = 'available'
-            items.append(item)
-        return items
+            item['body'] = item.get('body', item.get('body_id'))
+            item['priority'] = job.get('priority', 0)
+            item['attempts'] = job['attempts']
+            item['created'] = job['_id'].generation_time
+            item['locked_at'] = job['locked_at']
+            item['started_at'] = job.get('started_at') if item['status'] == 'locked' else None
+            item['progress'] = job.get('progress')
+            item['stage'] = job.get('stage')
+            yield item
 
 
 class Job(object):
@@ -224,9 +447,12 @@ class Job(object):
     def complete(self):
         """Job has been completed.
         """
-        return self._queue.collection.find_and_modify(
+        result = self._queue.collection.find_and_modify(
             {"_id": self.job_id, "locked_by": self._queue.consumer_id},
             remove=True)
+        # jobs of the same external may run now
+        self._queue.notify()
+        return result
 
     def error(self, message=None):
         """Note an error processing a job, and return it to the queue.
@@ -237,8 +463,9 @@ class Job(object):
                 "locked_by": None, "locked_at": None, "last_error": message},
                 "$inc": {"attempts": 1}})
 
-    def progress(self, count=0):
-        """Note progress on a long running task.
+    def progress(self, count=0, stage=None):
+        """Note progress on a long running task. Renews the lock, returns
+        None if the job isn't locked by this consumer anymore.
         """
         return self._queue.collection.find_and_modify(
             {
@@ -246,7 +473,7 @@ class Job(object):
                 "locked_by": self._queue.consumer_id
             },
             update={
-                "$set": {"progress": count, "locked_at": datetime.now()}
+                "$set": {"progress": count, "stage": stage, "locked_at": datetime.now()}
             }
         )
 
@@ -0,0 +1,148 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import pytz
+from dateutil.parser import parse as dateutil_parse
+from ..models import *
+
+
+class FieldPlan:
+    """
+    Everything save_object needs to know about the fields of a model, computed once per model: for every OParl
+    key the kind of conversion, the MongoDB field it is saved to and the referenced model.
+    """
+    SKIP = 0
+    VALUE = 1
+    DATETIME = 2
+    REFERENCE = 3
+    LIST_REFERENCE = 4
+
+    oparl_objects = {
+        object.__name__: object for object in [
+            Body, LegislativeTerm, Organization, Person, Membership, Meeting, AgendaItem, Consultation, Paper, File,
+            Location
+        ]
+    }
+    renamed_fields = {
+        'id': 'originalId',
+        'accessUrl': 'originalAccessUrl',
+        'downloadUrl': 'originalDownloadUrl'
+    }
+
+    def __init__(self, object):
+        self.steps = {}
+        self.types = {}
+        self.required = []
+        self.defaults = {}
+        for key, field in object._fields.items():
+            field_type = type(field).__name__
+            if field_type == 'ListField':
+                if getattr(field, 'external_list', False):
+                    self.steps[key] = (self.SKIP, key, None, None)
+                elif type(field.field).__name__ == 'ReferenceField':
+                    self.steps[key] = (self.LIST_REFERENCE, key, self.get_target(field.field), None)
+                else:
+                    self.steps[key] = (self.VALUE, key, None, None)
+            elif field_type == 'ReferenceField':
+                self.steps[key] = (self.REFERENCE, key, self.get_target(field), None)
+            elif field_type == 'DateTimeField':
+                self.steps[key] = (self.DATETIME, key, None, None)
+            else:
+                self.steps[key] = (self.VALUE, self.renamed_fields.get(key, key), None, self.get_converter(field_type))
+            self.types[key] = field_type
+            if field.required:
+                self.required.append(key)
+            # mongoengine saved scalar defaults with every document, so we keep doing that
+            if field.default is not None and not callable(field.default) and not isinstance(field.default, (list, dict)):
+                self.defaults[key] = field.default
+
+    def get_target(self, field):
+        target = field.document_type_obj
+        if type(target) != str:
+            target = target.__name__
+        return self.oparl_objects.get(target)
+
+    def get_converter(self, field_type):
+        if field_type == 'DecimalField':
+            return convert_decimal
+        if field_type == 'IntField':
+            return convert_int
+        if field_type == 'BooleanField':
+            return bool
+        return None
+
+    def convert_value(self, key, value):
+        """
+        Returns the MongoDB field and value of a plain OParl value, or None if it must not be saved.
+        """
+        kind, field, target, converter = self.steps[key]
+        if value is None:
+            return None
+        if kind == self.DATETIME:
+            value = convert_datetime(value)
+        elif converter:
+            value = converter(value)
+        if value is None:
+            return None
+        return field, value
+
+    def validate(self, object_json):
+        """
+        Returns the names of all fields which are missing or have a wrong type.
+        """
+        invalid = [key for key in self.required if key not in object_json]
+        for key, value in object_json.items():
+            field_type = self.types.get(key)
+            if field_type == 'StringField' and not isinstance(value, str):
+                invalid.append(key)
+            elif field_type == 'BooleanField' and not isinstance(value, bool):
+                invalid.append(key)
+            elif field_type in ['IntField', 'DecimalField'] and not isinstance(value, (int, float)):
+                invalid.append(key)
+            elif field_type == 'ListField' and not isinstance(value, list):
+                invalid.append(key)
+            elif field_type == 'DictField' and not isinstance(value, dict):
+                invalid.append(key)
+        return invalid
+
+
+def convert_datetime(value):
+    try:
+        dt = dateutil_parse(value)
+    except (ValueError, OverflowError, TypeError):
+        return None
+    if dt.tzname():
+        return dt.astimezone(pytz.timezone('UTC')).replace(tzinfo=None)
+    return dt
+
+
+def convert_decimal(value):
+    try:
+        return round(float(value), 2)
+    except (TypeError, ValueError):
+        return value
+
+
+def convert_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+field_plans = {}
+
+
+def get_field_plan(object):
+    if object not in field_plans:
+        field_plans[object] = FieldPlan(object)
+    return field_plans[object]
@@ -0,0 +1,180 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import time
+import random
+import socket
+import threading
+from urllib.parse import urlparse
+
+
+class HostLimiter:
+    """
+    Politeness per RIS host: at most max_requests requests in flight, started by a token bucket whose rate
+    adapts to the host (AIMD). The rate starts at 1 / wait_time, which is its ceiling as well, is halved on 429,
+    5xx and timeouts and grows additively back while the host answers fast. Bodies may opt into a faster rate
+    with body_max_rate, which grows up to that, but never above max_rate. Retry-After pauses the host, and
+    after circuit_failures failures in a row the circuit opens and pauses the host for circuit_cooldown seconds.
+    """
+
+    def __init__(self, max_requests, wait_time, min_rate=0.2, max_rate=5, latency_target=2,
+                 circuit_failures=10, circuit_cooldown=300, body_max_rate=None):
+        self.semaphore = threading.BoundedSemaphore(max_requests)
+        self.lock = threading.Lock()
+        self.min_rate = min_rate
+        self.rate_limit = max_rate
+        self.max_rate = max_rate
+        self.latency_target = latency_target
+        self.circuit_failures = circuit_failures
+        self.circuit_cooldown = circuit_cooldown
+        self.rate = self.max_rate
+        self.set_wait_time(wait_time, body_max_rate)
+        self.tokens = 1
+        self.last_refill = time.time()
+        self.paused_until = 0
+        self.failures = 0
+
+    def set_wait_time(self, wait_time, body_max_rate=None):
+        # the configured wait time is the starting rate and the ceiling, unless the body opted into a faster one
+        with self.lock:
+            self.max_rate = self.rate_limit
+            if body_max_rate:
+                self.max_rate = min(self.max_rate, body_max_rate)
+            elif wait_time:
+                self.max_rate = min(self.max_rate, 1 / wait_time)
+            self.rate = min(self.max_rate, 1 / wait_time) if wait_time else self.max_rate
+            self.min_rate = min(self.min_rate, self.rate)
+            self.wait_time = wait_time
+            self.body_max_rate = body_max_rate
+
+    def acquire(self, wait=True):
+        """
+        Blocks until a request may be started and returns the time spent sleeping.
+        """
+        self.semaphore.acquire()
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.paused_until > now:
+                    delay = self.paused_until - now
+                elif not wait:
+                    return waited
+                else:
+                    self.tokens = min(1, self.tokens + (now - self.last_refill) * self.rate)
+                    self.last_refill = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def release(self):
+        self.semaphore.release()
+
+    def success(self, latency):
+        with self.lock:
+            self.failures = 0
+            if latency < self.latency_target:
+                self.rate = min(self.max_rate, self.rate + 0.1 * self.max_rate)
+
+    def failure(self, retry_after=None):
+        """
+        Backs off after a 429, a 5xx or a timeout. Returns True if the circuit opened.
+        """
+        with self.lock:
+            self.failures += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            now = time.time()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if self.failures >= self.circuit_failures:
+                self.failures = 0
+                self.paused_until = max(self.paused_until, now + self.circuit_cooldown)
+                return True
+            return False
+
+
+def get_retry_delay(attempt, base=1, maximum=60):
+    """
+    Exponential backoff with full jitter, so parallel requests don't retry in lockstep.
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def get_retry_after(response):
+    """
+    Returns the seconds given in a Retry-After header. Http dates are not supported and treated as missing.
+    """
+    value = response.headers.get('Retry-After', '') if response is not None else ''
+    if value.isdigit():
+        return int(value)
+    return None
+
+
+host_limiters = {}
+host_limiters_lock = threading.Lock()
+
+
+def get_host_limiter(url, max_requests, wait_time, config, body_max_rate=None):
+    """
+    Returns the limiter of the url's host. Limiters are shared by all downloads of a process. body_max_rate is
+    the body's opt-in to requests faster than its wait_time.
+    """
+    host = urlparse(url).netloc
+    with host_limiters_lock:
+        if host not in host_limiters:
+            host_limiters[host] = HostLimiter(
+                max_requests,
+                wait_time,
+                min_rate=config.HOST_MIN_RATE,
+                max_rate=config.HOST_MAX_RATE,
+                latency_target=config.HOST_LATENCY_TARGET,
+                circuit_failures=config.HOST_CIRCUIT_FAILURES,
+                circuit_cooldown=config.HOST_CIRCUIT_COOLDOWN,
+                body_max_rate=body_max_rate
+            )
+        else:
+            # bodies sharing a host get the most polite limits of all of them
+            host_limiter = host_limiters[host]
+            if host_limiter.wait_time < wait_time or (host_limiter.body_max_rate and (
+                    not body_max_rate or body_max_rate < host_limiter.body_max_rate)):
+                host_limiter.set_wait_time(
+                    max(host_limiter.wait_time, wait_time),
+                    body_max_rate and host_limiter.body_max_rate and min(host_limiter.body_max_rate, body_max_rate)
+                )
+        return host_limiters[host]
+
+
+host_addresses = {}
+host_addresses_lock = threading.Lock()
+
+
+def get_host_address(url, cache_time=3600):
+    """
+    Returns the IP address of the url's host, so bodies of the same RIS vendor cloud share one address. Addresses
+    are cached per process for cache_time seconds. Hosts which can't be resolved are returned by name.
+    """
+    host = urlparse(url).hostname
+    if not host:
+        return None
+    with host_addresses_lock:
+        if host in host_addresses and host_addresses[host][1] > time.time():
+            return host_addresses[host][0]
+    try:
+        address = socket.gethostbyname(host)
+    except (socket.error, UnicodeError):
+        address = host
+    with host_addresses_lock:
+        host_addresses[host] = (address, time.time() + cache_time)
+    return address
@@ -0,0 +1,153 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import io
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+
+class HttpCache:
+    """
+    On-disk cache of OParl responses for conditional requests. Every url gets a body file and a meta file
+    with its ETag and Last-Modified header. The modified_since filter of list pages changes with every sync,
+    so pages are cached per list and page without it and revalidated by ETag only, which names the content
+    whatever the filter. Entries unused for max_age seconds are pruned, and the oldest ones as long as the
+    cache is bigger than max_size bytes.
+    """
+    prune_interval = 60 * 60
+    last_pruned = {}
+    prune_lock = threading.Lock()
+
+    def __init__(self, directory, max_age=None, max_size=None):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+        self.prune()
+
+    def is_filtered(self, url):
+        return any(key == 'modified_since' for key, value in parse_qsl(urlparse(url).query))
+
+    def get_key(self, url):
+        # the url without the modified_since filter, which is the list plus the page position
+        if not self.is_filtered(url):
+            return url
+        parsed = urlparse(url)
+        return parsed._replace(query=urlencode(
+            [(key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True) if key != 'modified_since']
+        )).geturl()
+
+    def get_path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(self.get_key(url).encode('utf-8')).hexdigest())
+
+    def get_headers(self, url):
+        """
+        Returns the If-None-Match / If-Modified-Since headers for url, empty if the url isn't cached.
+        """
+        try:
+            with open(self.get_path(url) + '.json') as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return {}
+        if not os.path.exists(self.get_path(url) + '.body'):
+            return {}
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        # a cached page may have been fetched with another filter, so only its ETag tells whether it's the same
+        if meta.get('last_modified') and not self.is_filtered(url):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def open(self, url):
+        try:
+            content_file = open(self.get_path(url) + '.body', 'rb')
+        except OSError:
+            return None
+        # the modification time is the last use, so used entries are pruned last
+        try:
+            os.utime(self.get_path(url) + '.body')
+        except OSError:
+            pass
+        return content_file
+
+    def save(self, url, headers, content_file):
+        """
+        Copies content_file to the cache and rewinds it afterwards.
+        """
+        meta = {
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified')
+        }
+        if self.is_filtered(url):
+            # the filter may drop objects from a page without changing the date of its newest object
+            meta['last_modified'] = None
+        if not meta['etag'] and not meta['last_modified']:
+            return
+        # write to temporary files first, so parallel list fetchers never see half a file
+        path = self.get_path(url)
+        self.write(path + '.body', content_file)
+        content_file.seek(0)
+        self.write(path + '.json', io.BytesIO(json.dumps(meta).encode('utf-8')))
+
+    def write(self, path, content_file):
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(file_descriptor, 'wb') as tmp_file:
+            shutil.copyfileobj(content_file, tmp_file)
+        os.replace(tmp_path, path)
+
+    def remove(self, url):
+        for extension in ['.json', '.body']:
+            try:
+                os.remove(self.get_path(url) + extension)
+            except OSError:
+                pass
+
+    def prune(self):
+        """
+        Removes entries unused for max_age seconds, then the oldest ones until the cache fits into max_size.
+        Runs at most once per prune_interval per process and directory.
+        """
+        with self.prune_lock:
+            if time.time() - self.last_pruned.get(self.directory, 0) < self.prune_interval:
+                return
+            self.last_pruned[self.directory] = time.time()
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith('.body'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, file_name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_name[:-5]))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        now = time.time()
+        for mtime, entry_size, name in entries:
+            expired = self.max_age is not None and now - mtime > self.max_age
+            too_big = self.max_size is not None and size > self.max_size
+            if not expired and not too_big:
+                break
+            for extension in ['.json', '.body']:
+                try:
+                    os.remove(os.path.join(self.directory, name + extension))
+                except OSError:
+                    pass
+            size -= entry_size
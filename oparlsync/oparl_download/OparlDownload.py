@@ -10,43 +10,51 @@ Redistribution and use in source and binary forms, with or without modification,
 THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import io
 import re
 import os
 import sys
 import time
 import json
 import pytz
+import queue
 import urllib
 import hashlib
 import datetime
-import requests
-from dateutil.parser import parse as dateutil_parse
-from ssl import SSLError
+import ijson
+import threading
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
 from geojson import Feature
 from urllib.parse import urlparse
 from ..models import *
 from ..base_task import BaseTask
+from .HostLimiter import get_host_limiter, get_retry_delay, get_retry_after
+from .OparlDownloadBulk import OparlDownloadBulk
+from .FieldPlan import FieldPlan, get_field_plan, convert_datetime
+from .HttpCache import HttpCache
+from .HttpSession import get_http_session
+from .UrlCache import UrlCache
+from .RawArchive import RawArchive, compact_archive
 from pymongo import ReturnDocument
 from bson.objectid import ObjectId
-from minio.error import ResponseError, SignatureDoesNotMatch
-from mongoengine.errors import ValidationError
 from pymongo.errors import ServerSelectionTimeoutError
-from requests.exceptions import ChunkedEncodingError
+from requests.exceptions import RequestException
 
 
-class OparlDownload(BaseTask):
+class OparlDownload(BaseTask, OparlDownloadBulk):
     name = 'OparlDownload'
     services = [
-        'mongodb',
-        's3'
+        'mongodb'
     ]
     oparl_version = '1.1'
     modified_since = None
+    replay = False
     body_id = None
 
     def __init__(self, **kwargs):
         self.body_id = kwargs.get('body')
-        super().__init__()
+        super().__init__(shared=kwargs.get('shared'))
 
         self.start_time = datetime.datetime.utcnow()
         self.valid_objects = [
@@ -72,13 +80,18 @@ class OparlDownload(BaseTask):
         # statistics
         self.mongodb_request_count = 0
         self.mongodb_request_cached = 0
+        self.mongodb_operation_count = 0
+        self.cache_preloaded = 0
+        self.fingerprint_skipped = 0
+        self.object_count = 0
         self.http_request_count = 0
+        self.http_cache_hits = 0
+        self.http_cache_misses = 0
+        self.http_retry_count = 0
         self.mongodb_request_time = 0
-        self.file_download_time = 0
-        self.download_not_required = 0
         self.http_request_time = 0
-        self.minio_time = 0
         self.wait_time = 0
+        self.statistics_lock = threading.Lock()
 
         self.body_uid = False
         self.organization_list_url = False
@@ -86,12 +99,36 @@ class OparlDownload(BaseTask):
         self.meeting_list_url = False
         self.paper_list_url = False
 
+        self.url_cache = UrlCache(self.get_sub_resource)
+        self.http_session = get_http_session(self.config.HTTP_POOL_SIZE)
+        self.http_cache = None
+        if self.config.OPARL_HTTP_CACHE:
+            self.http_cache = HttpCache(
+                self.config.TMP_HTTP_CACHE_DIR,
+                max_age=self.config.OPARL_HTTP_CACHE_MAX_AGE,
+                max_size=self.config.OPARL_HTTP_CACHE_MAX_SIZE
+            )
         self.reset_cache()
+        self.bulk_reset()
+        self.checkpoint_enabled = False
+        self.checkpoint_pending = {}
         self.modified_since = None
+        self.list_modified_since = {}
+        self.watermarks = {}
+        self.watermarks_enabled = False
+        self.lists_incomplete = set()
+        self.watermarks_pending = {}
         if kwargs.get('since'):
             self.modified_since = datetime.datetime.strptime(kwargs['since'], '%Y-%m-%d').strftime('%Y-%m-%dT%H:%M:%SZ')
-        self.body_id = kwargs.get('body')
-        self.run_full()
+        self.archive = None
+        if self.config.OPARL_ARCHIVE and not self.replay and self.body_id:
+            self.archive = RawArchive(os.path.join(self.config.ARCHIVE_DIR, self.body_id), self.config.OPARL_ARCHIVE_SEGMENT_SIZE)
+        try:
+            self.run_full()
+        finally:
+            if self.archive:
+                self.archive.close()
+                compact_archive(self.archive.directory, self.config.OPARL_ARCHIVE_MAX_SEGMENTS, self.datalog)
         """
         for arg in args:
             if arg.startswith('since='):
@@ -125,31 +162,81 @@ class OparlDownload(BaseTask):
         self.get_body()
         if not self.body_uid:
             return
+        self.set_modified_since()
+        self.watermarks_enabled = True
+        checkpoint = self.load_checkpoint() if self.config.OPARL_CHECKPOINT else {}
+        object_lists = []
         for object in self.body_objects:
-            self.get_list(object)
+            if object.__name__ not in checkpoint:
+                object_lists.append((object, self.get_list_url(object)))
+            elif checkpoint[object.__name__]:
+                object_lists.append((object, checkpoint[object.__name__]))
+        if not self.get_lists(object_lists):
+            self.datalog.warn('Body %s sync incomplete, it will be resumed at the next run. Results:' % self.body_id)
+            self.log_statistics(start_time)
+            self.set_sync_failed()
+            return
 
         # set last sync if everything is done so far
         body = Body.objects(id=self.body_uid).first()
         body.beforeLastSync = body.lastSync
         body.lastSync = self.start_time.isoformat()
         body.save()
+        self.db_raw.body.update_one({'_id': self.body_uid}, {'$unset': {'syncCheckpoint': 1, 'syncFailures': 1}})
 
         self.datalog.info('Body %s sync done. Results:' % self.body_id)
+        self.log_statistics(start_time)
+
+    def set_sync_failed(self):
+        """
+        Counts syncs in a row which left lists incomplete. Lists done already keep their watermark, so only
+        the failing lists are downloaded again. After OPARL_SYNC_MAX_FAILURES failures the admins are alerted.
+        """
+        self.mongodb_request_count += 1
+        body = self.db_raw.body.find_one_and_update(
+            {'_id': self.body_uid},
+            {'$inc': {'syncFailures': 1}},
+            projection={'syncFailures': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        failures = body.get('syncFailures', 0) if body else 0
+        if failures < self.config.OPARL_SYNC_MAX_FAILURES:
+            return
+        lists = ', '.join(sorted(object.__name__ for object in self.lists_incomplete))
+        self.datalog.error('Body %s: sync failed %s times in a row at lists %s' % (self.body_id, failures, lists))
+        if failures % self.config.OPARL_SYNC_MAX_FAILURES == 0:
+            self.send_mail(
+                self.config.ADMINS,
+                'oparl sync of body %s stalled' % self.body_id,
+                'Body %s failed %s times in a row, incomplete lists: %s' % (self.body_id, failures, lists)
+            )
+
+    def log_statistics(self, start_time):
+        self.datalog.info('objects:              %s' % self.object_count)
         self.datalog.info('mongodb requests:     %s' % self.mongodb_request_count)
+        self.datalog.info('mongodb operations:   %s' % self.mongodb_operation_count)
         self.datalog.info('cached requests:      %s' % self.mongodb_request_cached)
+        self.datalog.info('cached url requests:  %s' % self.url_cache.hits)
+        self.datalog.info('preloaded ids:        %s' % self.cache_preloaded)
+        self.datalog.info('unchanged objects:    %s (%s %%)' % (
+            self.fingerprint_skipped,
+            round(100 * self.fingerprint_skipped / max(self.fingerprint_skipped + self.object_count, 1), 1)
+        ))
         self.datalog.info('http requests:        %s' % self.http_request_count)
+        self.datalog.info('http retries:         %s' % self.http_retry_count)
+        self.datalog.info('http cache hits:      %s (%s %%)' % (
+            self.http_cache_hits,
+            round(100 * self.http_cache_hits / max(self.http_cache_hits + self.http_cache_misses, 1), 1)
+        ))
         self.datalog.info('mongodb time:         %s s' % round(self.mongodb_request_time, 1))
-        self.datalog.info('minio time:           %s s' % round(self.minio_time, 1))
         self.datalog.info('http time:            %s s' % round(self.http_request_time, 1))
-        self.datalog.info('file download time:   %s s' % round(self.file_download_time, 1))
-        self.datalog.info('download not reqired: %s' % self.download_not_required)
         self.datalog.info('wait time:            %s s' % round(self.wait_time, 1))
         self.datalog.info('app time:             %s s' % round(
-            time.time() - start_time - self.mongodb_request_time - self.minio_time - self.http_request_time - self.wait_time - self.file_download_time,
+            time.time() - start_time - self.mongodb_request_time - self.http_request_time - self.wait_time,
             1
         ))
         self.datalog.info('all time:             %s s' % round(time.time() - start_time, 1))
-        self.datalog.info('processed %s objects per second' % round(self.mongodb_request_count / (time.time() - start_time), 1))
+        self.datalog.info('processed %s objects per second' % round(self.object_count / (time.time() - start_time), 1))
 
     def run_single_by_list(self, body_id, list):
         self.body_config = self.get_body_config(body_id)
@@ -159,11 +246,10 @@ class OparlDownload(BaseTask):
             return
         if 'url' not in self.body_config:
             return
-        start_time = time.time()
         self.get_body()
         if not self.body_uid:
             return
-        self.get_list(Paper, list)
+        self.get_lists([(Paper, list)])
 
 
     def run_single_by_uid(self, body_id, uid):
@@ -176,11 +262,35 @@ class OparlDownload(BaseTask):
         for oparl_object in self.valid_objects:
             if data['type'] == oparl_object.type:
                 self.save_object(oparl_object, data)
+        self.bulk_flush()
 
     def reset_cache(self):
         self.cache = {}
+        self.fingerprints = {}
         for obj in self.valid_objects:
             self.cache[obj.__name__] = {}
+            self.fingerprints[obj.__name__] = {}
+
+    def warm_cache(self):
+        """
+        Preloads the ids of all objects of the body we stored in earlier runs, so known references
+        don't need a stub upsert at all.
+        """
+        id_field = 'mirrorId' if self.config.USE_MIRROR else 'originalId'
+        start_time = time.time()
+        for obj in self.valid_objects:
+            if obj == Body:
+                continue
+            self.mongodb_request_count += 1
+            projection = {id_field: 1, 'fingerprint': 1}
+            for result in self.db_raw[obj._object_db_name].find({'body': self.body_uid}, projection):
+                if id_field not in result:
+                    continue
+                self.cache[obj.__name__][result[id_field]] = result['_id']
+                self.cache_preloaded += 1
+                if 'fingerprint' in result:
+                    self.fingerprints[obj.__name__][result[id_field]] = result['fingerprint']
+        self.mongodb_request_time += time.time() - start_time
 
     def get_body(self, set_last_sync=True):
         self.body_uid = None
@@ -213,7 +323,7 @@ class OparlDownload(BaseTask):
         else:
             # Copy missing values from system object if necessary
             if not body_raw.get('licence') or not body_raw.get('contactName') or not body_raw.get('contactEmail'):
-                system_raw = self.get_url_json(body_raw['system'])
+                system_raw = self.url_cache.get(body_raw['system']) or {}
                 if system_raw.get('licence') and not body_raw.get('licence'):
                     body_raw['licence'] = system_raw['licence']
                 if system_raw.get('contactName') and not body_raw.get('contactName'):
@@ -235,7 +345,13 @@ class OparlDownload(BaseTask):
             self.last_update = pytz.UTC.localize(result['lastSync']).astimezone(pytz.timezone('Europe/Berlin'))
         else:
             self.last_update = None
+        self.watermarks = result.get('syncWatermarks', {})
+        if self.config.OPARL_WARM_CACHE:
+            self.warm_cache()
+        if self.archive:
+            self.archive.write('Body', body_raw)
         self.save_object(Body, body_raw)
+        self.bulk_flush()
 
         if body_raw['type'] == 'https://schema.oparl.org/1.0/Body':
             self.oparl_version = '1.0'
@@ -264,39 +380,203 @@ class OparlDownload(BaseTask):
                 Location
             ]
 
-    def get_list(self, object, list_url=None):
-        if list_url:
-            object_list = self.get_url_json(list_url, is_list=True)
-        else:
-            if self.modified_since:
-                pass
-            elif self.last_update and self.oparl_version == '1.1':
-                last_update_tmp = self.last_update
-                if self.config.USE_MIRROR:
-                    last_update_tmp = last_update_tmp - datetime.timedelta(weeks=1)
-                self.modified_since = last_update_tmp.strftime('%Y-%m-%dT%H:%M:%SZ')
-            elif self.last_update:
-                self.modified_since = (self.last_update - datetime.timedelta(days=90)).strftime('%Y-%m-%dT%H:%M:%SZ')
-            url = getattr(self, '%s_list_url' % object._object_db_name)
-            if self.modified_since:
-                url += '&' if '?' in url else '?'
-                url += 'modified_since=%s' % self.modified_since
-            object_list = self.get_url_json(url, is_list=True)
-        while object_list:
-            for object_raw in object_list['data']:
-                self.save_object(object, object_raw)
-            if 'next' in object_list['links']:
-                url = object_list['links']['next']
-                # Patching modified_since back in URL because some RIS loose it at page 2 :(
-                if 'modified_since' not in url and self.modified_since:
-                    url += '&' if '?' in url else '?'
-                    url += 'modified_since=%s' % self.modified_since
-                object_list = self.get_url_json(url, is_list=True)
-            else:
-                break
+    def set_modified_since(self):
+        """
+        Without an explicit since, OParl 1.1 lists continue at the newest modified value seen by the last
+        complete download of the list, but at most the start of that sync, minus OPARL_WATERMARK_MARGIN. Lists
+        without watermark fall back to lastSync.
+        """
+        if self.modified_since:
+            return
+        if self.last_update and self.oparl_version == '1.1':
+            last_update_tmp = self.last_update
+            if self.config.USE_MIRROR:
+                last_update_tmp = last_update_tmp - datetime.timedelta(weeks=1)
+            self.modified_since = last_update_tmp.strftime('%Y-%m-%dT%H:%M:%SZ')
+            for object_name, watermark in self.watermarks.items():
+                watermark = watermark - datetime.timedelta(seconds=self.config.OPARL_WATERMARK_MARGIN)
+                self.list_modified_since[object_name] = watermark.strftime('%Y-%m-%dT%H:%M:%SZ')
+        elif self.last_update:
+            self.modified_since = (self.last_update - datetime.timedelta(days=90)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def get_modified_since(self, object):
+        return self.list_modified_since.get(object.__name__, self.modified_since)
+
+    def get_list_url(self, object):
+        url = getattr(self, '%s_list_url' % object._object_db_name)
+        modified_since = self.get_modified_since(object)
+        if modified_since:
+            url += '&' if '?' in url else '?'
+            url += 'modified_since=%s' % modified_since
+        return url
+
+    def load_checkpoint(self):
+        """
+        Returns the next page url per object type of an interrupted sync, None for lists which were done already.
+        Unfinished lists must have the same modified_since as now. Otherwise a new checkpoint is started.
+        """
+        self.checkpoint_enabled = True
+        self.mongodb_request_count += 1
+        body = self.db_raw.body.find_one({'_id': self.body_uid}, {'syncCheckpoint': 1})
+        checkpoint = body.get('syncCheckpoint') if body else None
+        modified_since = dict((object.__name__, self.get_modified_since(object)) for object in self.body_objects)
+        if checkpoint and checkpoint.get('started') and isinstance(checkpoint.get('modifiedSince'), dict) and \
+                checkpoint['started'] > self.start_time - datetime.timedelta(seconds=self.config.OPARL_CHECKPOINT_MAX_AGE) and \
+                all(checkpoint['modifiedSince'].get(name) == modified_since.get(name)
+                    for name, url in checkpoint.get('lists', {}).items() if url):
+            self.datalog.info('Body %s: resuming sync started at %s' % (self.body_id, checkpoint['started']))
+            # changes during the interrupted run have to be fetched by the next sync
+            self.start_time = checkpoint['started']
+            return checkpoint.get('lists', {})
+        self.mongodb_request_count += 1
+        self.db_raw.body.update_one({'_id': self.body_uid}, {'$set': {'syncCheckpoint': {
+            'started': self.start_time,
+            'modifiedSince': modified_since,
+            'lists': {}
+        }}})
+        return {}
+
+    def set_checkpoint(self, object, url, watermark=None):
+        """
+        Remembers the next page url of a list and the watermark of a finished list, which are committed as soon
+        as all objects of the page are saved.
+        """
+        if self.checkpoint_enabled:
+            self.checkpoint_pending[object.__name__] = url
+        if self.watermarks_enabled and not url and watermark:
+            self.watermarks_pending[object.__name__] = watermark
+        if not self.bulk_size:
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        object_json = {}
+        if self.checkpoint_pending:
+            object_json['$set'] = {
+                'syncCheckpoint.lists.%s' % name: url for name, url in self.checkpoint_pending.items()
+            }
+        if self.watermarks_pending:
+            object_json['$max'] = {
+                'syncWatermarks.%s' % name: watermark for name, watermark in self.watermarks_pending.items()
+            }
+        if not object_json:
+            return
+        self.mongodb_request_count += 1
+        self.db_raw.body.update_one({'_id': self.body_uid}, object_json)
+        self.checkpoint_pending = {}
+        self.watermarks_pending = {}
+
+    def get_next_url(self, object, links):
+        if 'next' not in links:
+            return None
+        url = links['next']
+        # Patching modified_since back in URL because some RIS loose it at page 2 :(
+        modified_since = self.get_modified_since(object)
+        if 'modified_since' not in url and modified_since:
+            url += '&' if '?' in url else '?'
+            url += 'modified_since=%s' % modified_since
+        return url
+
+    def get_lists(self, object_lists):
+        """
+        Downloads all lists in parallel while the pages are saved one by one in the calling thread. Every list
+        fetches up to OPARL_LIST_PREFETCH pages ahead, so saving and downloading overlap. Returns whether all
+        lists were downloaded completely.
+        """
+        if not object_lists:
+            return True
+        lists_incomplete = set(object for object, url in object_lists)
+        self.lists_incomplete = lists_incomplete
+        watermarks = {}
+        page_queue = queue.Queue(maxsize=self.config.OPARL_LIST_PREFETCH * len(object_lists))
+        cancelled = threading.Event()
+        with ThreadPoolExecutor(max_workers=len(object_lists)) as executor:
+            lists_broken = set()
+            for object, url in object_lists:
+                executor.submit(self.fetch_list, object, url, page_queue, cancelled, lists_broken)
+            lists_running = len(object_lists)
+            try:
+                while lists_running:
+                    object, page = page_queue.get()
+                    if page is None:
+                        lists_running -= 1
+                        continue
+                    page_file, links, page_url = page
+                    if object in lists_broken:
+                        page_file.close()
+                        continue
+                    self.set_progress(stage=object.__name__)
+                    try:
+                        with page_file:
+                            for object_raw in ijson.items(page_file, 'data.item', use_float=True):
+                                modified = convert_datetime(object_raw.get('modified'))
+                                if modified and (object not in watermarks or modified > watermarks[object]):
+                                    watermarks[object] = modified
+                                if self.archive:
+                                    self.archive.write(object.__name__, object_raw)
+                                self.save_object(object, object_raw)
+                                self.set_progress(increment=1)
+                    except ijson.JSONError as err:
+                        # the checkpoint stays at this page, the other lists go on
+                        self.datalog.error('%s: %s list page is broken: %s' % (self.body_config['id'], object.__name__, err))
+                        lists_broken.add(object)
+                        if self.http_cache:
+                            self.http_cache.remove(page_url)
+                        continue
+                    next_url = self.get_next_url(object, links)
+                    if not next_url:
+                        lists_incomplete.discard(object)
+                        # lists aren't paged by modified, so an object changed during the sync may sit on a page
+                        # fetched before a page with a newer modified. The watermark never passes the start of the
+                        # sync, which also advances complete lists without changes, so lists done already don't
+                        # fall back to lastSync while another list keeps failing.
+                        watermarks[object] = min(watermarks.get(object, self.start_time), self.start_time)
+                    self.set_checkpoint(object, next_url, watermarks.get(object))
+            except BaseException:
+                # stop fetching and drain the queue so no fetching thread blocks forever
+                cancelled.set()
+                while lists_running:
+                    object, page = page_queue.get()
+                    if page is None:
+                        lists_running -= 1
+                    else:
+                        page[0].close()
+                raise
+        self.bulk_flush()
+        return not lists_incomplete
+
+    def fetch_list(self, object, url, page_queue, cancelled, lists_broken=()):
+        try:
+            page = self.get_url_page(url)
+            if page is False:
+                # the RIS doesn't offer this list, so it's done as an empty one. Other failures leave it incomplete.
+                self.datalog.warn('%s: list %s not found, treated as empty' % (self.body_config['id'], url))
+                page = (io.BytesIO(b'{"data": []}'), {})
+            elif page is None:
+                self.datalog.error('%s: list %s is no valid OParl list' % (self.body_config['id'], url))
+            while page and not cancelled.is_set() and object not in lists_broken:
+                page_queue.put((object, page + (url,)))
+                url = self.get_next_url(object, page[1])
+                if not url:
+                    break
+                page = self.get_url_page(url)
+        except Exception as err:
+            self.datalog.error('%s: list %s failed: %s' % (self.body_config['id'], url, err))
+        finally:
+            page_queue.put((object, None))
 
     def save_object(self, object, object_raw, validate=True):
-        object_instance = object()
+        # Skip objects which are unchanged since they were saved the last time
+        fingerprint = None
+        if self.config.OPARL_FINGERPRINT and 'id' in object_raw:
+            fingerprint = self.get_fingerprint(object_raw)
+            object_key = self.get_original_id(object_raw['id'])
+            if self.fingerprints[object.__name__].get(object_key) == fingerprint and object_key in self.cache[object.__name__] \
+                    and not self.replay:
+                self.fingerprint_skipped += 1
+                return object_key
+
+        field_plan = get_field_plan(object)
+        object_json = {}
         dbref_data = {}
 
         # Stupid Bugfix for Person -> Location as locationObject
@@ -306,105 +586,81 @@ class OparlDownload(BaseTask):
 
         # Iterate though all Objects and fix stuff (recursive)
         for key, value in object_raw.items():
-            if key in object_instance._fields:
-                # List of something
-                if type(object_instance._fields[key]).__name__ == 'ListField':
-                    external_list = False
-                    if hasattr(object_instance._fields[key], 'external_list'):
-                        if object_instance._fields[key].external_list:
-                            continue
-                    # List of relations
-                    if type(object_instance._fields[key].field).__name__ == 'ReferenceField':
-                        dbref_data[key] = []
-                        for valid_object in self.valid_objects:
-                            check = object_instance._fields[key].field.document_type_obj
-                            if type(check) != str:
-                                check = check.__name__
-                            if valid_object.__name__ == check:
-                                for single in value:
-                                    if valid_object.__name__ == 'Body':
-                                        dbref_data[key].append(ObjectId(self.body_uid))
-                                        continue
-                                    if isinstance(single, dict) or key == 'derivativeFile':
-                                        # we have to get derivativeFile now because it's in no other list
-                                        if key == 'derivativeFile':
-                                            sub_object_raw = self.get_url_json(single, False)
-                                        else:
-                                            sub_object_raw = single
-                                        if 'created' not in sub_object_raw and 'created' in object_raw:
-                                            sub_object_raw['created'] = object_raw['created']
-                                        if 'modified' not in sub_object_raw and 'modified' in object_raw:
-                                            sub_object_raw['modified'] = object_raw['modified']
-                                        dbref_data[key].append(ObjectId(self.save_object(valid_object, sub_object_raw, True)['_id']))
-                                    else:
-                                        if single in self.cache[valid_object.__name__]:
-                                            dbref_data[key].append(self.cache[valid_object.__name__][single])
-                                            self.mongodb_request_cached += 1
-                                            continue
-                                        dbref_data[key].append(ObjectId(self.save_object(valid_object, {'id': single}, False)['_id']))
-                    # List of Non-Relation
-                    else:
-                        self.save_document_values(object_instance, key, value)
-                # Single Relation
-                elif type(object._fields[key]).__name__ == 'ReferenceField':
-                    for valid_object in self.valid_objects:
-                        check = object_instance._fields[key].document_type_obj
-                        if type(check) != str:
-                            check = check.__name__
-                        if valid_object.__name__ == check:
-                            if valid_object.__name__ == 'Body':
-                                dbref_data[key] = ObjectId(self.body_uid)
+            if key not in field_plan.steps:
+                continue
+            kind, field, valid_object, converter = field_plan.steps[key]
+            # List of relations
+            if kind == FieldPlan.LIST_REFERENCE:
+                if not valid_object:
+                    continue
+                dbref_data[key] = []
+                for single in value or []:
+                    if valid_object == Body:
+                        dbref_data[key].append(ObjectId(self.body_uid))
+                        continue
+                    if isinstance(single, dict) or key == 'derivativeFile':
+                        # we have to get derivativeFile now because it's in no other list
+                        if key == 'derivativeFile':
+                            sub_object_raw = self.url_cache.get(single)
+                            if not sub_object_raw:
                                 continue
-                            # Stupid bugfix for Person -> Location is an object id
-                            if object.__name__ == 'Person' and valid_object.__name__ == 'Location' and isinstance(value, str) and not self.config.USE_MIRROR:
-                                value = self.get_url_json(value)
-                            if isinstance(value, dict):
-                                sub_object_raw = value
-                                if 'created' not in sub_object_raw and 'created' in object_raw:
-                                    sub_object_raw['created'] = object_raw['created']
-                                if 'modified' not in sub_object_raw and 'modified' in object_raw:
-                                    sub_object_raw['modified'] = object_raw['modified']
-                                dbref_data[key] = ObjectId(self.save_object(valid_object, sub_object_raw, True)['_id'])
-                            else:
-                                if value in self.cache[valid_object.__name__]:
-                                    dbref_data[key] = self.cache[valid_object.__name__][value]
-                                    self.mongodb_request_cached += 1
-                                    continue
-                                dbref_data[key] = ObjectId(self.save_object(valid_object, {'id': value}, False)['_id'])
-                # No relation or list
-                else:
-                    self.save_document_values(object_instance, key, value)
+                        else:
+                            sub_object_raw = single
+                        if 'created' not in sub_object_raw and 'created' in object_raw:
+                            sub_object_raw['created'] = object_raw['created']
+                        if 'modified' not in sub_object_raw and 'modified' in object_raw:
+                            sub_object_raw['modified'] = object_raw['modified']
+                        dbref_data[key].append(self.get_reference(valid_object, self.save_object(valid_object, sub_object_raw, True)))
+                    else:
+                        dbref_data[key].append(self.save_reference(valid_object, single))
+            # Single Relation
+            elif kind == FieldPlan.REFERENCE:
+                if not valid_object:
+                    continue
+                if valid_object == Body:
+                    dbref_data[key] = ObjectId(self.body_uid)
+                    continue
+                # Stupid bugfix for Person -> Location is an object id
+                if object == Person and valid_object == Location and isinstance(value, str) and not self.config.USE_MIRROR:
+                    value = self.url_cache.get(value)
+                if isinstance(value, dict):
+                    sub_object_raw = value
+                    if 'created' not in sub_object_raw and 'created' in object_raw:
+                        sub_object_raw['created'] = object_raw['created']
+                    if 'modified' not in sub_object_raw and 'modified' in object_raw:
+                        sub_object_raw['modified'] = object_raw['modified']
+                    dbref_data[key] = self.get_reference(valid_object, self.save_object(valid_object, sub_object_raw, True))
+                elif value:
+                    dbref_data[key] = self.save_reference(valid_object, value)
+            elif key == 'id':
+                object_json['originalId'] = self.get_original_id(value)
+            # No relation
+            elif kind != FieldPlan.SKIP:
+                converted = field_plan.convert_value(key, value)
+                if converted:
+                    object_json[converted[0]] = converted[1]
+        for key, value in field_plan.defaults.items():
+            if key not in object_json:
+                object_json[key] = value
 
         # Validate Object and log invalid objects
         if object != Body and validate:
-            try:
-                object_instance.validate()
-            except ValidationError as err:
+            if field_plan.validate(object_json):
                 self.datalog.warn(
                     '%s %s from Body %s failed validation.' % (object.__name__, object_raw['id'], self.body_uid))
         # fix modified
-        if object_instance.created and object_instance.modified:
-            if object_instance.created > object_instance.modified:
-                object_instance.modified = object_instance.created
+        if object_json.get('created') and object_json.get('modified'):
+            if object_json['created'] > object_json['modified']:
+                object_json['modified'] = object_json['created']
 
         # Etwas umständlicher Weg über pymongo
+        object_key = object_json.get('originalId')
         if self.config.USE_MIRROR:
-            query = {
-                'mirrorId': object_instance.originalId
-            }
-            object_instance.mirrorId = object_instance.originalId
+            object_json['mirrorId'] = object_key
             if self.config.OPARL_MIRROR_PREFIX + ':originalId' in object_raw:
-                object_instance.originalId = object_raw[self.config.OPARL_MIRROR_PREFIX + ':originalId']
-            else:
-                del object_instance.originalId
-        else:
-            query = {
-                'originalId': object_instance.originalId
-            }
-        object_json = json.loads(object_instance.to_json())
-        for field_key in object_json.keys():
-            if type(object_instance._fields[field_key]).__name__ == 'DateTimeField':
-                object_json[field_key] = getattr(object_instance, field_key)
+                object_json['originalId'] = object_raw[self.config.OPARL_MIRROR_PREFIX + ':originalId']
+            elif 'originalId' in object_json:
+                del object_json['originalId']
 
         # Body ID related Fixes
         if object == Location:
@@ -415,10 +671,10 @@ class OparlDownload(BaseTask):
                         geojson_check = Feature(geometry=object_json['geojson']['geometry'])
                         if not geojson_check.is_valid:
                             del object_json['geojson']
-                            self.datalog.warn('invalid geojson found at %s' % object_instance.originalId)
+                            self.datalog.warn('invalid geojson found at %s' % object_key)
                     except ValueError:
                         del object_json['geojson']
-                        self.datalog.warn('invalid geojson found at %s' % object_instance.originalId)
+                        self.datalog.warn('invalid geojson found at %s' % object_key)
 
         elif object == Body:
             if self.body_config['name']:
@@ -426,6 +682,10 @@ class OparlDownload(BaseTask):
         else:
             object_json['body'] = self.body_uid
 
+        if fingerprint:
+            object_json['fingerprint'] = fingerprint
+            self.fingerprints[object.__name__][object_key] = fingerprint
+
         # Set some File values if using mirror
         if object == File and self.config.USE_MIRROR:
             object_json['storedAtMirror'] = True
@@ -438,154 +698,66 @@ class OparlDownload(BaseTask):
             if self.config.OPARL_MIRROR_PREFIX + ':originalDownloadUrl' in object_raw:
                 object_json['originalDownloadUrl'] = object_raw[self.config.OPARL_MIRROR_PREFIX + ':originalDownloadUrl']
 
-        # set all the dbrefs generated before
-        object_json.update(dbref_data)
+        # set all the dbrefs generated before, unresolved ones are set when the batch is flushed
+        references = {}
+        for key, value in dbref_data.items():
+            if isinstance(value, tuple) or (isinstance(value, list) and any(isinstance(item, tuple) for item in value)):
+                references[key] = value
+            else:
+                object_json[key] = value
 
         # delete empty lists and dicts
         for key in list(object_json):
             if (isinstance(object_json[key], list) or isinstance(object_json[key], dict)) and not object_json[key]:
                 del object_json[key]
 
+        # Changed files are marked for the FileDownload stage, which fetches the binaries afterwards
+        if object == File and not self.config.USE_MIRROR and 'originalAccessUrl' in object_json and not self.replay:
+            if not (self.body_config['force_full_sync'] == 1 and self.last_update and object_json.get('modified') and
+                    object_json['modified'] < self.last_update.astimezone(pytz.UTC).replace(tzinfo=None)):
+                object_json['downloaded'] = False
+                object_json['downloadAttempts'] = 0
+
         # Save data
-        object_json = { '$set': object_json }
-        self.correct_document_values(object_json['$set'])
-        self.mongodb_request_count += 1
-        start_time = time.time()
-        result = self.db_raw[object._object_db_name].find_one_and_update(
-            query,
-            object_json,
-            upsert=True,
-            return_document=ReturnDocument.AFTER
-        )
-        self.datalog.debug('%s %s from Body %s saved successfully.' % (object.__name__, result['_id'], self.body_uid))
-        self.mongodb_request_time += time.time() - start_time
 
-        # Cache Original ID -> MongoDB ID
-        if self.config.USE_MIRROR:
-            if object_instance.mirrorId not in self.cache[object.__name__]:
-                self.cache[object.__name__][object_instance.mirrorId] = ObjectId(result['_id'])
-        else:
-            if object_instance.originalId not in self.cache[object.__name__]:
-                self.cache[object.__name__][object_instance.originalId] = ObjectId(result['_id'])
-
-        # We need to download files if necessary
-        if object == File and not self.config.USE_MIRROR:
-            download_file = True
-            if self.body_config['force_full_sync'] == 1 and self.last_update and object_instance.modified:
-                if object_instance.modified < self.last_update:
-                    download_file = False
-            if 'downloaded' not in result:
-                download_file = True
-            elif not result['downloaded']:
-                download_file = True
-            if 'originalAccessUrl' in object_json['$set'] and download_file:
-                file_name_internal = str(result['_id'])
-                start_time = time.time()
-                file_status = self.download_file(object_json['$set']['originalAccessUrl'], file_name_internal)
-                self.file_download_time += time.time() - start_time
-                if not file_status:
-                    self.datalog.warn('No valid file could be downloaded at File %s from Body %s' % (result['_id'], self.body_uid))
-                else:
-                    start_time = time.time()
-                    object_json_update = {}
-                    mime_type = None
-                    if 'mimeType' in object_json['$set']:
-                        mime_type = object_json['$set']['mimeType']
-                    file_name = None
-                    if 'fileName' in object_json['$set']:
-                        file_name = object_json['$set']['fileName']
-                    else:
-                        splitted_file_name = object_json['$set']['originalAccessUrl'].split('/')
-                        if len(splitted_file_name):
-                            if len(splitted_file_name[-1]) > 3 and '.' in splitted_file_name[-1]:
-                                file_name = splitted_file_name[-1]
-                    if not file_name or not mime_type:
-                        self.datalog.warn('No file name or no mime type avaliable at File %s from Body %s' % (
-                        result['_id'], self.body_uid))
-                    else:
-                        content_type = object_json['$set']['mimeType']
-                        metadata = {
-                            'Content-Disposition': 'filename=%s' % file_name
-                        }
-                        try:
-                            self.s3.fput_object(
-                                self.config.S3_BUCKET,
-                                "files/%s/%s" % (self.body_uid, file_name_internal),
-                                os.path.join(self.config.TMP_FILE_DIR, file_name_internal),
-                                content_type=content_type,
-                                metadata=metadata
-                            )
-                            self.datalog.debug('Binary file at File %s from Body %s saved successfully.' % (result['_id'], self.body_uid))
-                            object_json_update['downloaded'] = True
-                        except (ResponseError, SignatureDoesNotMatch) as err:
-                            self.datalog.warn(
-                                'Critical error saving file from File %s from Body %s' % (result['_id'], self.body_uid))
-                    self.minio_time += time.time() - start_time
-                    if 'size' not in object_json['$set']:
-                        object_json_update['size'] = os.path.getsize(os.path.join(self.config.TMP_FILE_DIR, file_name_internal))
-                    if 'sha1Checksum' not in object_json['$set'] or 'sha512Checksum' not in object_json['$set']:
-                        with open(os.path.join(self.config.TMP_FILE_DIR, file_name_internal), 'rb') as checksum_file:
-                            checksum_file_content = checksum_file.read()
-                            if 'sha1Checksum' not in object_json['$set']:
-                                object_json_update['sha1Checksum'] = hashlib.sha1(checksum_file_content).hexdigest()
-                            if 'sha512Checksum' not in object_json['$set']:
-                                object_json_update['sha512Checksum'] = hashlib.sha512(checksum_file_content).hexdigest()
-                    if len(object_json_update.keys()):
-                        result = self.db_raw[object._object_db_name].find_one_and_update(
-                            query,
-                            { '$set': object_json_update },
-                            upsert=True,
-                            return_document=ReturnDocument.AFTER
-                        )
-                        self.mongodb_request_count += 1
-                    os.remove(os.path.join(self.config.TMP_FILE_DIR, file_name_internal))  # also get all derivativeFile
-            else:
-                self.download_not_required += 1
-
-        # If we have a Paper with a Location, we need to mark this as official=ris relation if processing is enabled
-        if object == Paper and 'location' in object_json['$set'] and self.config.ENABLE_PROCESSING and False:
-            for location_obj_id in object_json['$set']['location']:
-                if not LocationOrigin.objects(paper=ObjectId(result['_id']), location=location_obj_id, origin='ris').no_cache().count():
-                    location_origin = LocationOrigin()
-                    location_origin.location = location_obj_id
-                    location_origin.paper = ObjectId(result['_id'])
-                    location_origin.origin = 'ris'
-
-                    location_origin.save()
-                    self.mongodb_request_count += 3
-                    paper = Paper.objects(id=ObjectId(result['_id'])).no_cache().first()
-                    if location_origin.id not in paper.locationOrigin:
-                        paper.locationOrigin.append(location_origin.id)
-                        paper.save()
-                        self.mongodb_request_count += 1
-                    # delete refs
-                    location_origin = None
-                    paper = None
-
-        return result
-
-    def save_document_values(self, document, key, value):
-        if type(document._fields[key]).__name__ == 'DateTimeField':
-            try:
-                dt = dateutil_parse(value)
-            except ValueError:
-                delattr(document, key)
-                return
-            if dt.tzname():
-                setattr(document, key, dt.astimezone(pytz.timezone('UTC')).replace(tzinfo=None))
-            else:
-                setattr(document, key, dt)
-        elif key == 'id':
-            # temporary fix for missing body/1/
-            if '/body/1' not in value:
-                value = value.replace('/oparl/v1', '/oparl/v1/body/1')
-            setattr(document, 'originalId', value)
-        elif key == 'accessUrl':
-            setattr(document, 'originalAccessUrl', value)
-        elif key == 'downloadUrl':
-            setattr(document, 'originalDownloadUrl', value)
-        else:
-            setattr(document, key, value)
+        self.object_count += 1
+        self.bulk_upsert(object, object_key, object_json, references)
+        return object_key
+
+    def save_reference(self, object, value):
+        """
+        Saves a reference given as OParl id. Objects we don't know yet are saved as stub with the id only.
+        """
+        object_key = self.get_original_id(value)
+        if object_key in self.cache[object.__name__]:
+            self.mongodb_request_cached += 1
+        elif object != Body:
+            object_json = {
+                'mirrorId' if self.config.USE_MIRROR else 'originalId': object_key,
+                'body': [self.body_uid] if object == Location else self.body_uid
+            }
+            if object == File and self.config.USE_MIRROR:
+                object_json['storedAtMirror'] = True
+            self.bulk_upsert(object, object_key, object_json)
+        return self.get_reference(object, object_key)
+
+    def get_sub_resource(self, url):
+        """
+        Fetches objects which are referenced by url only. They are archived with their url for replays.
+        """
+        data = self.get_url_json(url)
+        if self.archive and data:
+            self.archive.write('url', data, url)
+        return data
+
+    def get_fingerprint(self, object_raw):
+        return hashlib.sha1(json.dumps(object_raw, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+    def get_original_id(self, value):
+        # temporary fix for missing body/1/
+        if '/body/1' not in value:
+            value = value.replace('/oparl/v1', '/oparl/v1/body/1')
+        return value
 
     def correct_document_values(self, document_json):
         for key, value in document_json.items():
@@ -593,54 +765,119 @@ class OparlDownload(BaseTask):
                 if '$date' in value:
                     document_json[key] = datetime.datetime.fromtimestamp(value['$date'] / 1000).isoformat()
 
-    def get_url_json(self, url, is_list=False, wait=True):
-        if url:
-            if wait:
-                if 'wait_time' in self.body_config:
-                    self.wait_time += self.body_config['wait_time']
-                    time.sleep(self.body_config['wait_time'])
-                else:
-                    self.wait_time += self.config.GET_URL_WAIT_TIME
-                    time.sleep(self.config.GET_URL_WAIT_TIME)
-            self.datalog.info('%s: get %s' % (self.body_config['id'], url))
-            self.http_request_count += 1
-            start_time = time.time()
-            r = requests.get(url, timeout=300)
-            self.http_request_time += time.time() - start_time
-            if r.status_code == 500:
+    def get_url_json(self, url, wait=True):
+        """
+        Returns the OParl object at url or None. List pages are fetched by get_url_page.
+        """
+        if not url:
+            return None
+        try:
+            content_file = self.get_url_file(url, wait)
+        except RequestException as err:
+            self.datalog.error('%s: get %s failed: %s' % (self.body_config['id'], url, err))
+            return None
+        if content_file is None:
+            return None
+        with content_file:
+            try:
+                data = json.loads(content_file.read())
+            except ValueError:
+                return None
+        return data
+
+    def get_url_page(self, url):
+        """
+        Returns a list page as file and its links. Only the links are parsed here, the data items are parsed
+        one by one while saving, so the size of a page doesn't matter. Returns False if the server answers 404
+        or 410 and None if the page is no valid list page.
+        """
+        page_file = self.get_url_file(url, not_found=False)
+        if page_file is None or page_file is False:
+            return page_file
+        try:
+            links = next(ijson.items(page_file, 'links'), None)
+        except ijson.JSONError:
+            links = None
+        if links is None:
+            page_file.close()
+            return None
+        page_file.seek(0)
+        return page_file, links
+
+    def get_url_file(self, url, wait=True, use_cache=True, not_found=None):
+        """
+        Returns the response body of url as file, spooled to disk if it's big. If the url was fetched before
+        and the server sent an ETag or Last-Modified header, a conditional request is made and a 304 is
+        answered from the http cache. 429, 5xx and connection errors are retried with jittered backoff, the
+        host limiter adapts its rate. 404 and 410 return not_found, other failures None.
+        """
+        host_limiter = get_host_limiter(
+            url,
+            self.config.OPARL_HOST_MAX_REQUESTS,
+            self.body_config.get('wait_time', self.config.GET_URL_WAIT_TIME),
+            self.config,
+            self.body_config.get('max_rate')
+        )
+        headers = self.http_cache.get_headers(url) if self.http_cache and use_cache else {}
+        for attempt in range(self.config.OPARL_HTTP_RETRIES + 1):
+            if attempt:
+                time.sleep(get_retry_delay(attempt))
+            r = None
+            error = None
+            content_file = None
+            wait_time = host_limiter.acquire(wait)
+            try:
+                self.datalog.info('%s: get %s' % (self.body_config['id'], url))
+                start_time = time.time()
+                r = self.http_session.get(url, headers=headers, timeout=300, stream=True)
+                if r.status_code == 200:
+                    content_file = SpooledTemporaryFile(max_size=self.config.OPARL_SPOOL_SIZE, dir=self.config.TMP_DIR)
+                    for chunk in r.iter_content(chunk_size=64 * 1024):
+                        content_file.write(chunk)
+                    content_file.seek(0)
+            except RequestException as err:
+                error = err
+                r = None
+            finally:
+                host_limiter.release()
+                if r is not None:
+                    r.close()
+            request_time = time.time() - start_time
+            with self.statistics_lock:
+                self.wait_time += wait_time
+                self.http_request_count += 1
+                self.http_request_time += request_time
+                if attempt:
+                    self.http_retry_count += 1
+            if r is not None and r.status_code != 429 and r.status_code < 500:
+                host_limiter.success(request_time)
+                break
+            if host_limiter.failure(get_retry_after(r)):
+                self.datalog.warn('%s: host of %s paused after repeated failures' % (self.body_config['id'], url))
+        else:
+            if r is None:
+                raise error
+            if r.status_code >= 500:
                 self.send_mail(
                     self.config.ADMINS,
                     'critical error at oparl-mirror',
-                    'url %s throws an http error 500' % url
+                    'url %s throws an http error %s' % (url, r.status_code)
                 )
-                return None
-            elif r.status_code == 200:
-                try:
-                    if not is_list:
-                        return r.json()
-                    else:
-                        list_data = r.json()
-                        if 'data' in list_data and 'links' in list_data:
-                            return list_data
-                except json.decoder.JSONDecodeError:
-                    return None
+            r.raise_for_status()
+        if r.status_code == 304 and headers:
+            content_file = self.http_cache.open(url)
+            if content_file is None:
+                # the cache entry vanished in between, so we need the full response
+                return self.get_url_file(url, wait, False, not_found)
+            with self.statistics_lock:
+                self.http_cache_hits += 1
+            return content_file
+        elif r.status_code == 200:
+            if self.http_cache:
+                self.http_cache.save(url, r.headers, content_file)
+                with self.statistics_lock:
+                    self.http_cache_misses += 1
+            return content_file
+        elif r.status_code in [404, 410]:
+            return not_found
         return None
-
-    def download_file(self, url, file_name):
-        try:
-            r = requests.get(url, stream=True, timeout=300)
-        except (SSLError, ConnectionResetError):
-            return False
-        if r.status_code != 200:
-            return False
-        try:
-            with open(os.path.join(self.config.TMP_FILE_DIR, file_name), 'wb') as f:
-                try:
-                    for chunk in r.iter_content(chunk_size=1024):
-                        if chunk:
-                            f.write(chunk)
-                except ChunkedEncodingError:
-                    return True
-                return True
-        except ConnectionResetError:
-            return False
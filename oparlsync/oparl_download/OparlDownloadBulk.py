@@ -0,0 +1,112 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import time
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from bson.objectid import ObjectId
+from ..models import *
+
+
+class OparlDownloadBulk:
+    """
+    Collects all upserts of a sync and writes them as unordered bulk requests. References to objects which are
+    not known yet are stored as (object, key) and resolved with one $in lookup per collection when flushing.
+    """
+
+    def bulk_reset(self):
+        self.bulk_documents = {}
+        self.bulk_references = {}
+        self.bulk_size = 0
+
+    def bulk_upsert(self, object, key, document, references=None):
+        if object not in self.bulk_documents:
+            self.bulk_documents[object] = {}
+            self.bulk_references[object] = {}
+        if key in self.bulk_documents[object]:
+            self.bulk_documents[object][key].update(document)
+        else:
+            self.bulk_documents[object][key] = document
+            self.bulk_size += 1
+        if references:
+            self.bulk_references[object].setdefault(key, {}).update(references)
+        if self.bulk_size >= self.config.OPARL_BULK_SIZE:
+            self.bulk_flush()
+
+    def get_reference(self, object, key):
+        """
+        Returns the ObjectId if the object is known already, otherwise a placeholder which is resolved at flush.
+        """
+        if object == Body:
+            return ObjectId(self.body_uid)
+        if key in self.cache[object.__name__]:
+            return self.cache[object.__name__][key]
+        return (object, key)
+
+    def bulk_flush(self):
+        if not self.bulk_size:
+            return
+        id_field = 'mirrorId' if self.config.USE_MIRROR else 'originalId'
+
+        # save all documents without unresolved references
+        for object, documents in self.bulk_documents.items():
+            self.bulk_write(object, [
+                UpdateOne({id_field: key}, {'$set': document}, upsert=True) for key, document in documents.items()
+            ])
+
+        # get the MongoDB ids of all new documents with one request per collection
+        for object, documents in self.bulk_documents.items():
+            keys = [key for key in documents.keys() if key not in self.cache[object.__name__]]
+            if not keys:
+                continue
+            self.mongodb_request_count += 1
+            start_time = time.time()
+            for result in self.db_raw[object._object_db_name].find({id_field: {'$in': keys}}, {id_field: 1}):
+                self.cache[object.__name__][result[id_field]] = result['_id']
+            self.mongodb_request_time += time.time() - start_time
+
+        # set the references which are resolvable now
+        for object, references in self.bulk_references.items():
+            requests = []
+            for key, fields in references.items():
+                resolved = {}
+                for field, value in fields.items():
+                    value = self.resolve_reference(value)
+                    if value:
+                        resolved[field] = value
+                if resolved:
+                    requests.append(UpdateOne({id_field: key}, {'$set': resolved}))
+            self.bulk_write(object, requests)
+
+        self.datalog.debug('%s objects from Body %s saved successfully.' % (self.bulk_size, self.body_uid))
+        self.bulk_reset()
+        self.save_checkpoint()
+
+    def resolve_reference(self, value):
+        if isinstance(value, list):
+            return [item for item in [self.resolve_reference(item) for item in value] if item]
+        if isinstance(value, tuple):
+            return self.cache[value[0].__name__].get(value[1])
+        return value
+
+    def bulk_write(self, object, requests):
+        if not requests:
+            return
+        self.mongodb_request_count += 1
+        self.mongodb_operation_count += len(requests)
+        start_time = time.time()
+        try:
+            self.db_raw[object._object_db_name].bulk_write(requests, ordered=False)
+        except BulkWriteError as err:
+            self.datalog.warn('%s of %s %s writes from Body %s failed.' % (
+                len(err.details['writeErrors']), len(requests), object.__name__, self.body_uid))
+        self.mongodb_request_time += time.time() - start_time
@@ -0,0 +1,69 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from ..base_task import BaseTask
+from .OparlDownload import OparlDownload
+
+
+class OparlDownloadMany(BaseTask):
+    """
+    Syncs several bodies at once inside one process. All syncs share the connections, the http session and the
+    host limiters, so slow RIS don't need a process each.
+    """
+    name = 'OparlDownloadMany'
+    services = [
+        'mongodb'
+    ]
+
+    def __init__(self, **kwargs):
+        super().__init__()
+        self.bodies_done = []
+        body_ids = self.get_body_ids(kwargs.get('body'))
+        self.datalog.info('Sync of %s bodies launched.' % len(body_ids))
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=self.config.OPARL_PARALLEL_BODIES) as executor:
+            for body_id in executor.map(lambda body_id: self.sync_body(body_id, kwargs), body_ids):
+                if body_id:
+                    self.bodies_done.append(body_id)
+        self.datalog.info('Sync of %s bodies done in %s s, %s failed.' % (
+            len(body_ids),
+            round(time.time() - start_time, 1),
+            len(body_ids) - len(self.bodies_done)
+        ))
+
+    def get_body_ids(self, body):
+        """
+        Returns the ids of all active bodies for 'all', otherwise the comma separated ids.
+        """
+        if body != 'all':
+            return [body_id for body_id in (body or '').split(',') if body_id]
+        body_ids = []
+        for filename in sorted(os.listdir(self.config.BODY_DIR)):
+            if filename[-4:] != '.yml':
+                continue
+            body_config = self.get_body_config(filename=filename)
+            if body_config and 'legacy' not in body_config:
+                body_ids.append(body_config['id'])
+        return body_ids
+
+    def sync_body(self, body_id, kwargs):
+        body_kwargs = dict(kwargs, body=body_id, shared=self)
+        try:
+            OparlDownload(**body_kwargs)
+        except Exception:
+            self.datalog.error('Body %s sync failed:\n%s' % (body_id, traceback.format_exc()))
+            return None
+        return body_id
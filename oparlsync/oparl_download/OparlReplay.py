@@ -0,0 +1,66 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import time
+from .OparlDownload import OparlDownload
+from .RawArchive import read_archive
+
+
+class OparlReplay(OparlDownload):
+    """
+    Saves the raw objects archived by earlier syncs again, e.g. after normalization changed. No http requests
+    and no waits are made, objects are saved even if their fingerprint is unchanged. With since, only the
+    segments archived from that day on are replayed.
+    """
+    name = 'OparlReplay'
+    replay = True
+
+    def __init__(self, **kwargs):
+        self.replay_since = kwargs.get('since')
+        super().__init__(**kwargs)
+
+    def run_full(self):
+        self.body_config = self.get_body_config(self.body_id)
+        self.datalog.info('Body %s replay launched.' % self.body_id)
+        if not self.body_config:
+            self.datalog.error('body id %s configuration not found' % self.body_id)
+            return
+        self.mongodb_request_count += 1
+        body = self.db_raw.body.find_one({'uid': self.body_config['id']}, {'_id': 1, 'lastSync': 1})
+        if not body:
+            self.datalog.error('body id %s was never synced' % self.body_id)
+            return
+        self.body_uid = body['_id']
+        self.last_update = None
+        if self.config.OPARL_WARM_CACHE:
+            self.warm_cache()
+        start_time = time.time()
+        archive_dir = os.path.join(self.config.ARCHIVE_DIR, self.body_id)
+        # sub-resources are archived while the objects referencing them are saved, so they are loaded first
+        for line in read_archive(archive_dir, self.datalog, self.replay_since):
+            if line['type'] == 'url':
+                self.url_cache.results[line['url']] = line['data']
+        objects = dict((object.__name__, object) for object in self.valid_objects)
+        for line in read_archive(archive_dir, self.datalog, self.replay_since):
+            if line['type'] in objects:
+                self.save_object(objects[line['type']], line['data'])
+        self.bulk_flush()
+
+        self.datalog.info('Body %s replay done. Results:' % self.body_id)
+        self.datalog.info('objects:              %s' % self.object_count)
+        self.datalog.info('mongodb requests:     %s' % self.mongodb_request_count)
+        self.datalog.info('mongodb operations:   %s' % self.mongodb_operation_count)
+        self.datalog.info('all time:             %s s' % round(time.time() - start_time, 1))
+
+    def get_sub_resource(self, url):
+        return None
@@ -0,0 +1,138 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import json
+import gzip
+import time
+import zlib
+import threading
+
+
+class RawArchive:
+    """
+    Append-only archive of the raw OParl objects of one body. Every sync writes new gzipped JSON lines
+    segments named by its start time and process, so old segments are only touched by compact_archive.
+    """
+
+    def __init__(self, directory, segment_size):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.prefix = '%s-%s' % (time.strftime('%Y-%m-%d--%H-%M-%S'), os.getpid())
+        self.segment = None
+        self.segment_count = 0
+        self.lines = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write(self, object_type, data, url=None):
+        line = {
+            'type': object_type,
+            'data': data
+        }
+        if url:
+            line['url'] = url
+        line = json.dumps(line, separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.segment is None or self.lines >= self.segment_size:
+                self.open_segment()
+            self.segment.write(line.encode('utf-8'))
+            self.lines += 1
+
+    def open_segment(self):
+        self.close_segment()
+        self.segment_count += 1
+        self.segment = gzip.open(
+            os.path.join(self.directory, '%s-%04d.jsonl.gz' % (self.prefix, self.segment_count)),
+            'xb'
+        )
+        self.lines = 0
+
+    def close_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+    def close(self):
+        with self.lock:
+            self.close_segment()
+
+
+def get_segments(directory, since=None):
+    """
+    Names of all segments in the order they were written. since is a date like 1970-01-01, older segments are
+    left out.
+    """
+    if not os.path.isdir(directory):
+        return []
+    return [segment_name for segment_name in sorted(os.listdir(directory))
+            if segment_name.endswith('.jsonl.gz') and (not since or segment_name[:10] >= since)]
+
+
+def read_segment(directory, segment_name, datalog=None):
+    try:
+        with gzip.open(os.path.join(directory, segment_name), 'rb') as segment:
+            for line in segment:
+                yield json.loads(line.decode('utf-8'))
+    except (EOFError, OSError, zlib.error, ValueError):
+        if datalog:
+            datalog.warn('archive segment %s is incomplete' % segment_name)
+
+
+def read_archive(directory, datalog=None, since=None):
+    """
+    Yields all lines of all segments in the order they were written, beginning with the segments written at
+    since. Segments of crashed syncs are read up to the point where they break off.
+    """
+    for segment_name in get_segments(directory, since):
+        for line in read_segment(directory, segment_name, datalog):
+            yield line
+
+
+def get_line_key(line):
+    if line['type'] == 'url':
+        return 'url', line.get('url')
+    if isinstance(line['data'], dict) and line['data'].get('id'):
+        return line['type'], line['data']['id']
+    return None
+
+
+def compact_archive(directory, max_segments, datalog=None):
+    """
+    Rewrites the archive into one segment holding the latest line per object and url as soon as it has more
+    than max_segments segments, so replays don't grow with the number of syncs. The first pass only keeps the
+    position of the latest line per key. The compacted segment is in place before the old ones are removed,
+    so a crash leaves duplicates at worst.
+    """
+    segment_names = get_segments(directory)
+    if len(segment_names) <= max_segments:
+        return
+    latest = {}
+    for segment_number, segment_name in enumerate(segment_names):
+        for line_number, line in enumerate(read_segment(directory, segment_name, datalog)):
+            key = get_line_key(line)
+            if key:
+                latest[key] = (segment_number, line_number)
+    compacted_name = segment_names[-1][:-len('.jsonl.gz')] + '-compacted.jsonl.gz'
+    tmp_path = os.path.join(directory, compacted_name + '.tmp')
+    with gzip.open(tmp_path, 'wb') as compacted:
+        for segment_number, segment_name in enumerate(segment_names):
+            for line_number, line in enumerate(read_segment(directory, segment_name, datalog)):
+                key = get_line_key(line)
+                if key and latest[key] != (segment_number, line_number):
+                    continue
+                compacted.write((json.dumps(line, separators=(',', ':')) + '\n').encode('utf-8'))
+    os.replace(tmp_path, os.path.join(directory, compacted_name))
+    for segment_name in segment_names:
+        os.remove(os.path.join(directory, segment_name))
+    if datalog:
+        datalog.info('archive %s compacted from %s segments and %s objects' % (directory, len(segment_names), len(latest)))
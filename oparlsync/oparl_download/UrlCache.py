@@ -0,0 +1,52 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import threading
+from copy import deepcopy
+
+
+class UrlCache:
+    """
+    Results of dereferenced sub-resources of one sync run. Concurrent requests for the same url wait for the
+    first one instead of fetching it again (single flight). Callers get copies, as saving modifies objects.
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.results = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def get(self, url):
+        with self.lock:
+            if url in self.results:
+                self.hits += 1
+                return deepcopy(self.results[url])
+            event = self.pending.get(url)
+            fetching = event is None
+            if fetching:
+                event = self.pending[url] = threading.Event()
+        if not fetching:
+            event.wait()
+            with self.lock:
+                self.hits += 1
+                return deepcopy(self.results.get(url))
+        result = None
+        try:
+            result = self.fetch(url)
+        finally:
+            with self.lock:
+                self.results[url] = result
+                del self.pending[url]
+            event.set()
+        return deepcopy(result)
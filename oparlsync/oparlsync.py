@@ -12,9 +12,9 @@ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
 
 import os
 import sys
+import time
 import yaml
 import errno
-import socket
 import signal
 import daemon
 import logging
@@ -22,16 +22,19 @@ import pymongo
 import lockfile
 from logging.handlers import WatchedFileHandler
 from copy import deepcopy
+from datetime import datetime, timezone
 import daemon.pidfile
-from urllib.parse import urlparse
 from multiprocessing import Value
 from setproctitle import setproctitle
 from .config import get_config
 from .mongoqueue import MongoQueue
+from .connections import setup_s3
 
 from .worker import Worker
 
-from oparlsync.oparl_download import OparlDownload
+from oparlsync.oparl_download import OparlDownload, OparlDownloadMany, OparlReplay
+from oparlsync.oparl_download.HostLimiter import get_host_address
+from oparlsync.file_download import FileDownload
 from oparlsync.generate_thumbnails import GenerateThumbnails
 from oparlsync.generate_fulltext import GenerateFulltext
 from oparlsync.maintenance import Maintenance
@@ -46,6 +49,9 @@ from oparlsync.misc import Misc
 class OparlSync():
     modules = {
         'download': OparlDownload,
+        'download-many': OparlDownloadMany,
+        'replay': OparlReplay,
+        'files': FileDownload,
         'thumbnails': GenerateThumbnails,
         'fulltext': GenerateFulltext,
         'worker': Maintenance,
@@ -83,14 +89,26 @@ class OparlSync():
         self.init_queue()
         if kwargs.get('module') not in self.modules:
             sys.exit('fatal: module should be one of %s' % '|'.join(self.modules.keys()))
+        if kwargs.get('module') == 'download-many':
+            # one job syncs all given bodies, 'all' or a comma separated list of body ids
+            payload = {
+                'module': 'download-many',
+                'body': kwargs.get('body')
+            }
+            for key in ['since', 'nonext']:
+                if kwargs.get(key):
+                    payload[key] = kwargs[key]
+            self.queue_network.put(payload)
+            return
+        options = dict((key, value) for key, value in kwargs.items() if key not in ['module', 'body'])
         if kwargs.get('body') == 'all':
             bodies = os.listdir(self.config.BODY_DIR)
             for body in bodies:
                 if body[-4:] != '.yml':
                     continue
-                self.queue_add_single(kwargs.get('module'), body, **kwargs)
+                self.queue_add_single(kwargs.get('module'), body, **options)
         else:
-            self.queue_add_single(kwargs.get('module'), kwargs.get('body'), **kwargs)
+            self.queue_add_single(kwargs.get('module'), kwargs.get('body'), **options)
 
     def queue_add_single(self, module, body_file, **kwargs):
         body_config = self.get_body_config(filename=body_file)
@@ -99,39 +117,107 @@ class OparlSync():
         if body_config['active'] and 'legacy' not in body_config:
             payload = {
                 'module': module,
-                'body_id': body_config['id']
+                'body': body_config['id']
             }
-            if module == 'oparl_download':
-                url = urlparse(body_config['url'])
-                ip = socket.gethostbyname(url.netloc)
-                if ip:
-                    kwargs['external'] = ip
-            self.queue_network.put(payload, **kwargs)
+            for key in ['since', 'nonext']:
+                if kwargs.get(key):
+                    payload[key] = kwargs[key]
+            external = None
+            if module in self.config.QUEUE_HOST_MODULES:
+                external = get_host_address(body_config['url'], self.config.QUEUE_HOST_CACHE_TIME)
+            self.get_queue(module).put(payload, external=external)
 
     def queue_clear(self, **kwargs):
         self.init_queue()
-        if kwargs.get('force'):
-            self.queue_network.clear()
-        else:
-            self.queue_network.clear_safe()
+        for queue in [self.queue_network, self.queue_local]:
+            if kwargs.get('force'):
+                queue.clear()
+            else:
+                queue.clear_safe()
 
     def queue_list(self, **kwargs):
         self.init_queue()
-        jobs = self.queue_network.details()
-        print('| Body ID        | Job                    | Status    |')
-        print('|----------------|------------------------|-----------|')
+        for pool, queue in [('network', self.queue_network), ('local', self.queue_local)]:
+            if kwargs.get('pool') and kwargs['pool'] != pool:
+                continue
+            if kwargs.get('module') and self.get_pool(kwargs['module']) != pool:
+                continue
+            print('%s queue:' % pool)
+            self.queue_list_single(queue, **kwargs)
+            print('')
+
+    def queue_list_single(self, queue, **kwargs):
+        jobs = queue.details(
+            status=kwargs.get('status'),
+            module=kwargs.get('module'),
+            body=kwargs.get('body'),
+            skip=kwargs.get('skip') or 0,
+            limit=kwargs.get('limit') or 0
+        )
+        now = datetime.now(timezone.utc)
+        print('| Body ID                  | Job                    | Status    | Prio | Tries | Waiting   | Progress             | Rate      |')
+        print('|--------------------------|------------------------|-----------|------|-------|-----------|----------------------|-----------|')
         for job in jobs:
-            print('| %s | %s | %s |' % (job['body_id'], job['module'].ljust(22), job['status'].ljust(9)))
+            progress = ''
+            rate = ''
+            if job['started_at']:
+                progress = ('%s %s' % (job['progress'] or 0, job['stage'] or '')).strip()
+                running = (datetime.now() - job['started_at']).total_seconds()
+                if running > 0:
+                    rate = '%s/min' % round(60 * (job['progress'] or 0) / running, 1)
+            print('| %s | %s | %s | %s | %s | %s | %s | %s |' % (
+                str(job['body']).ljust(24),
+                job['module'].ljust(22),
+                job['status'].ljust(9),
+                str(job['priority']).rjust(4),
+                str(job['attempts']).rjust(5),
+                self.format_duration(now - job['created']).rjust(9),
+                progress[:20].ljust(20),
+                rate.rjust(9)
+            ))
 
     def queue_stats(self, **kwargs):
         self.init_queue()
-        stats = self.queue_network.stats()
+        print('network queue (%s workers):' % self.config.THREADS_NETWORK_MAX)
+        self.queue_stats_single(self.queue_network)
+        print('')
+        print('local queue (%s workers):' % self.config.THREADS_LOCAL_MAX)
+        self.queue_stats_single(self.queue_local)
+
+    def queue_stats_single(self, queue):
+        stats = queue.stats()
+        now = datetime.now(timezone.utc)
         print('available: %s' % (int(stats['available'])))
         print('locked   : %s' % (int(stats['locked'])))
         print('total    : %s' % (int(stats['total'])))
         print('errors   : %s' % (int(stats['errors'])))
-
-    def daemon_status(self):
+        print('coalesced: %s' % (int(stats['coalesced'])))
+        if stats['oldest']:
+            print('waiting  : %s' % self.format_duration(now - stats['oldest']))
+        groups = queue.stats(group_by=['module'])
+        if not groups:
+            return
+        print('')
+        print('| Job                    | Status    | Count  | Merged | Oldest    |')
+        print('|------------------------|-----------|--------|--------|-----------|')
+        for group in groups:
+            print('| %s | %s | %s | %s | %s |' % (
+                str(group.get('module')).ljust(22),
+                group['status'].ljust(9),
+                str(group['count']).rjust(6),
+                str(group['coalesced']).rjust(6),
+                self.format_duration(now - group['oldest']).rjust(9)
+            ))
+
+    def format_duration(self, duration):
+        seconds = int(duration.total_seconds())
+        if seconds < 3600:
+            return '%sm %ss' % (seconds // 60, seconds % 60)
+        if seconds < 86400:
+            return '%sh %sm' % (seconds // 3600, seconds % 3600 // 60)
+        return '%sd %sh' % (seconds // 86400, seconds % 86400 // 3600)
+
+    def get_daemon_status(self):
         if not os.path.isfile(os.path.join(self.config.TMP_DIR, 'app.pid')):
             return False
         pidfile = open(os.path.join(self.config.TMP_DIR, 'app.pid'), 'r')
@@ -164,6 +250,8 @@ class OparlSync():
             print('Daemon not running.')
         else:
             print('Daemon running with pid %s.' % status)
+            print('network pool: %s workers' % self.config.THREADS_NETWORK_MAX)
+            print('local pool  : %s workers' % self.config.THREADS_LOCAL_MAX)
 
     def daemon_start(self, detach_process=True):
         if self.get_daemon_status():
@@ -192,6 +280,8 @@ class OparlSync():
         try:
             with daemon_context:
                 self.init_queue()
+                # bucket and policies are set up once, the workers inherit that they are ready
+                setup_s3(self.config)
 
                 # Logging (Status)
 
@@ -200,11 +290,30 @@ class OparlSync():
                 # Thread-Liste (Netzwerk)
                 self.threads_network = []
                 for i in range(0, self.config.THREADS_NETWORK_MAX):
-                    self.threads_network.append(Worker('network-%s' % (i + 1), do_shutdown=self.do_shutdown))
+                    self.threads_network.append(Worker('network-%s' % (i + 1), do_shutdown=self.do_shutdown, pool='network'))
                     self.threads_network[i].start()
 
-                for i in range(0, self.config.THREADS_NETWORK_MAX):
-                    self.threads_network[i].join()
+                # Thread-Liste (Lokal)
+                self.threads_local = []
+                for i in range(0, self.config.THREADS_LOCAL_MAX):
+                    self.threads_local.append(Worker('local-%s' % (i + 1), do_shutdown=self.do_shutdown, pool='local'))
+                    self.threads_local[i].start()
+                self.statuslog.info('Started %s network and %s local workers' % (
+                    self.config.THREADS_NETWORK_MAX, self.config.THREADS_LOCAL_MAX))
+
+                # reaper: jobs of crashed workers are put back into the queue as soon as their lease expires
+                while self.do_shutdown.value != 1:
+                    for queue in [self.queue_network, self.queue_local]:
+                        repaired = queue.repair()
+                        if repaired:
+                            self.statuslog.warning('%s jobs with expired lease put back into the queue' % repaired)
+                    for i in range(self.config.QUEUE_REAPER_INTERVAL):
+                        if self.do_shutdown.value == 1:
+                            break
+                        time.sleep(1)
+
+                for thread in self.threads_network + self.threads_local:
+                    thread.join()
 
         except lockfile.AlreadyLocked:
             self.statuslog.info('Daemon already running.')
@@ -230,10 +339,33 @@ class OparlSync():
         # Queue (Netzwerk)
         self.queue_network = MongoQueue(
             db_raw.queue_network,
+            notifications=db_raw.queue_network_events,
             consumer_id="main",
-            timeout=300,
-            max_attempts=3
+            timeout=self.config.QUEUE_LEASE_TIME,
+            max_attempts=3,
+            max_per_external=self.config.QUEUE_HOST_MAX_JOBS,
+            unique_keys=['module', 'body'],
+            min_keys=['since'],
+            match_keys=['nonext']
         )
+        # Queue (Lokal)
+        self.queue_local = MongoQueue(
+            db_raw.queue_local,
+            notifications=db_raw.queue_local_events,
+            consumer_id="main",
+            timeout=self.config.QUEUE_LEASE_TIME,
+            max_attempts=3,
+            unique_keys=['module', 'body'],
+            min_keys=['since'],
+            match_keys=['nonext']
+        )
+
+    def get_pool(self, module):
+        # CPU bound jobs go to the local pool, everything waiting on the network to the network pool
+        return 'local' if module in self.config.QUEUE_LOCAL_MODULES else 'network'
+
+    def get_queue(self, module):
+        return self.queue_local if self.get_pool(module) == 'local' else self.queue_network
 
     def init_statuslog(self):
         self.statuslog = logging.getLogger('statuslog')
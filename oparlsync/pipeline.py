@@ -0,0 +1,109 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import pymongo
+from datetime import datetime
+from pymongo import ReturnDocument
+
+# Post-processing stages of a body and the stages each of them needs as input. A stage is queued as soon as
+# all of its inputs which take part in the run are done, so independent stages run on different workers.
+STAGES = {
+    'download': [],
+    'replay': [],
+    'files': ['download'],
+    'backrefs': ['download', 'replay'],
+    'thumbnails': ['files'],
+    'fulltext': ['files', 'backrefs'],
+    'georefs': ['fulltext'],
+    'elastic': ['georefs'],
+    'misc': ['elastic'],
+    'sitemap': ['elastic']
+}
+
+# stages which are skipped if ENABLE_PROCESSING is off
+PROCESSING_STAGES = ['thumbnails', 'fulltext', 'georefs', 'elastic', 'misc', 'sitemap']
+
+
+class Pipeline():
+    """
+    Runs the stage DAG per body. Every run is stored with the stages taking part and the stages done and
+    started, so each stage is queued exactly once even if its inputs are completed by different workers at
+    the same time. Runs start at the stage of the job which was queued from outside, e.g. download, replay or
+    fulltext, and consist of all stages depending on it.
+    """
+
+    def __init__(self, collection, put, processing=True, run_max_age=7 * 24 * 60 * 60):
+        self.collection = collection
+        self.put = put
+        self.stages = {}
+        for stage, inputs in STAGES.items():
+            if processing or stage not in PROCESSING_STAGES:
+                self.stages[stage] = [input for input in inputs if processing or input not in PROCESSING_STAGES]
+        self.collection.create_index([('created', pymongo.ASCENDING)], expireAfterSeconds=run_max_age)
+
+    def get_dependents(self, stage):
+        return [dependent for dependent, inputs in self.stages.items() if stage in inputs]
+
+    def get_run_stages(self, root):
+        run_stages = [root]
+        for stage in run_stages:
+            for dependent in self.get_dependents(stage):
+                if dependent not in run_stages:
+                    run_stages.append(dependent)
+        return run_stages
+
+    def start(self, root, payload):
+        return self.collection.insert({
+            'root': root,
+            'body': payload.get('body', payload.get('body_id')),
+            'stages': self.get_run_stages(root),
+            'done': [],
+            'started': [root],
+            'created': datetime.now()
+        })
+
+    def complete(self, stage, payload):
+        """
+        Marks the stage as done at the payload's run and at all runs merged into the job, and queues all stages
+        whose inputs are done now.
+        """
+        if stage not in self.stages:
+            return
+        run_ids = [payload['run']] if payload.get('run') else []
+        run_ids += [run_id for run_id in payload.get('runs', []) if run_id not in run_ids]
+        if not payload.get('run'):
+            run_ids.insert(0, self.start(stage, payload))
+        payload = dict((key, value) for key, value in payload.items() if key not in ['run', 'runs'])
+        for run_id in run_ids:
+            self.complete_run(stage, payload, run_id)
+
+    def complete_run(self, stage, payload, run_id):
+        run = self.collection.find_one_and_update(
+            {'_id': run_id},
+            {'$addToSet': {'done': stage}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not run:
+            return
+        for dependent in self.get_dependents(stage):
+            if dependent not in run['stages']:
+                continue
+            inputs = [input for input in self.stages[dependent] if input in run['stages']]
+            if not all(input in run['done'] for input in inputs):
+                continue
+            # only the worker which marks the stage as started queues it
+            result = self.collection.update_one(
+                {'_id': run_id, 'started': {'$ne': dependent}},
+                {'$addToSet': {'started': dependent}}
+            )
+            if result.modified_count:
+                self.put(dict(payload, module=dependent, run=run_id))
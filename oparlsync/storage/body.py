@@ -11,7 +11,7 @@ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
 """
 
 from mongoengine import Document, BooleanField, ReferenceField, DateTimeField, StringField, ListField, DecimalField, \
-    GeoJsonBaseField, DictField
+    GeoJsonBaseField, DictField, IntField
 from .oparl_document import OParlDocument
 
 
@@ -49,9 +49,13 @@ class Body(Document, OParlDocument):
     legacy = BooleanField(vendor_attribute=True)
     originalId = StringField(vendor_attribute=True)
     mirrorId = StringField(vendor_attribute=True)
+    fingerprint = StringField(vendor_attribute=True)
     lastSync = DateTimeField(datetime_format='datetime', vendor_attribute=True)
     beforeLastSync = DateTimeField(datetime_format='datetime', vendor_attribute=True)
     statistics = DictField(vendor_attribute=True)
+    syncCheckpoint = DictField(vendor_attribute=True)
+    syncWatermarks = DictField(vendor_attribute=True)
+    syncFailures = IntField(vendor_attribute=True)
 
     # Felder zur Verarbeitung
     _object_db_name = 'body'
@@ -19,6 +19,7 @@ class File(Document, OParlDocument):
     meta = {
         'indexes': [
             'originalId',
+            'blob',
             {
                 'fields': ['$name', "$text", 'body'],
                 'default_language': 'english',
@@ -56,8 +57,11 @@ class File(Document, OParlDocument):
     # Politik bei Uns Felder
     legacy = BooleanField(vendor_attribute=True)
     downloaded = BooleanField(vendor_attribute=True)
+    downloadAttempts = IntField(vendor_attribute=True)
+    blob = StringField(vendor_attribute=True)
     originalId = StringField(vendor_attribute=True)
     mirrorId = StringField(vendor_attribute=True)
+    fingerprint = StringField(vendor_attribute=True)
     storedAtMirror = BooleanField(vendor_attribute=True)
     mirrorDownloadUrl = StringField(vendor_attribute=True)
     mirrorAccessUrl = StringField(vendor_attribute=True)
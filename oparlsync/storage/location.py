@@ -45,6 +45,7 @@ class Location(Document, OParlDocument):
     # Politik bei Uns Felder
     originalId = StringField(vendor_attribute=True)
     mirrorId = StringField(vendor_attribute=True)
+    fingerprint = StringField(vendor_attribute=True)
     autogenerated = BooleanField(vendor_attribute=True)
     region = ReferenceField('Region', vendor_attribute=True, delete_street=True)
     street = ReferenceField('Street', vendor_attribute=True)
@@ -49,6 +49,7 @@ class Paper(Document, OParlDocument):
     legacy = BooleanField(vendor_attribute=True)
     originalId = StringField(vendor_attribute=True)
     mirrorId = StringField(vendor_attribute=True)
+    fingerprint = StringField(vendor_attribute=True)
     georeferenceStatus = StringField(vendor_attribute=True)
     georeferenceGenerated = DateTimeField(datetime_format='datetime', vendor_attribute=True)
     keywordUsergenerated = ListField(ReferenceField('KeywordUsergenerated'), vendor_attribute=True)
@@ -11,19 +11,22 @@ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
 """
 
 import os
-import sys
-import time
+import yaml
+import socket
 import signal
-import pymongo
 import logging
 import smtplib
 import traceback
 from multiprocessing import Process
 from setproctitle import setproctitle
 from .config import get_config
-from .mongoqueue import MongoQueue
+from .mongoqueue import MongoQueue, Heartbeat
+from .connections import get_mongodb, close_connections
+from .pipeline import Pipeline
 
-from oparlsync.oparl_download import OparlDownload
+from oparlsync.oparl_download import OparlDownload, OparlDownloadMany, OparlReplay
+from oparlsync.oparl_download.HostLimiter import get_host_address
+from oparlsync.file_download import FileDownload
 from oparlsync.generate_thumbnails import GenerateThumbnails
 from oparlsync.generate_fulltext import GenerateFulltext
 from oparlsync.maintenance import Maintenance
@@ -38,7 +41,10 @@ from oparlsync.misc import Misc
 
 class Worker(Process):
     modules = {
-        'ownload': OparlDownload,
+        'download': OparlDownload,
+        'download-many': OparlDownloadMany,
+        'replay': OparlReplay,
+        'files': FileDownload,
         'thumbnails': GenerateThumbnails,
         'fulltext': GenerateFulltext,
         'worker': Maintenance,
@@ -50,91 +56,129 @@ class Worker(Process):
         'misc': Misc
     }
 
-    def __init__(self, process_name, do_shutdown, **kwargs):
+    def __init__(self, process_name, do_shutdown, pool='network', **kwargs):
         super(Worker, self).__init__()
         self.process_name = process_name
+        self.pool = pool
         self.do_shutdown = do_shutdown
         signal.signal(signal.SIGINT, signal.SIG_IGN)
 
     def run(self):
-        self.tick = 0
         self.load_config()
         self.init_statuslog()
         self.init_queue()
+        self.queue = self.queue_local if self.pool == 'local' else self.queue_network
 
-        if self.config.ENABLE_PROCESSING:
-            self.next_job = {
-                'download': ['backrefs', 'thumbnails'],
-                'backrefs': ['fulltext'],
-                'fulltext': ['georefs'],
-                'ggeorefs': ['elastic'],
-                'elastic': ['misc', 'sitemap']
-            }
-        else:
-            self.next_job = {
-                'download': ['backrefs']
-            }
         setproctitle('%s worker: idle ' % (self.config.PROJECT_NAME))
         self.statuslog.info('Process %s started!' % self.process_name)
         while True:
-            if self.tick % 100 == 0:
-                job = self.queue_network.next()
-
-                if job:
-                    current_module = None
-                    try:
-                        setproctitle('%s worker: %s %s ' % (self.config.PROJECT_NAME, job.payload['module'], job.payload.get('body', '')))
-                        current_module = self.modules[job.payload['module']](**job.payload)
-                    except:
-                        self.send_mail(
-                            self.config.ADMINS,
-                            'critical error at oparl-mirror',
-                            "Body ID: %s\nBacktrace:\n%s" % (job.payload['body_id'], traceback.format_exc())
-                        )
-                    finally:
-                        if current_module:
-                            current_module.close()
-                        self.add_next_to_queue(job.payload['module'], **job.payload)
-                        job.complete()
-                        current_module = None
-                        setproctitle('%s worker: idle ' % self.config.PROJECT_NAME)
-            if self.tick >= 100000:
-                self.tick = 0
-            self.tick += 1
-            time.sleep(.1)
+            job = self.queue.next()
+            if job:
+                self.run_job(job)
+            else:
+                # sleeps until a job is put into the queue, polling is the fallback only
+                self.queue.wait(self.config.QUEUE_POLL_INTERVAL, lambda: self.do_shutdown.value == 1)
             if self.do_shutdown.value == 1:
                 self.graceful_shutdown()
                 break
 
+    def run_job(self, job):
+        current_module = None
+        heartbeat = Heartbeat(job, self.config.QUEUE_HEARTBEAT_INTERVAL)
+        heartbeat.start()
+        try:
+            setproctitle('%s worker: %s %s ' % (self.config.PROJECT_NAME, job.payload['module'], job.payload.get('body', '')))
+            current_module = self.modules[job.payload['module']](**job.payload)
+        except:
+            self.send_mail(
+                self.config.ADMINS,
+                'critical error at oparl-mirror',
+                "Body ID: %s\nBacktrace:\n%s" % (job.payload.get('body'), traceback.format_exc())
+            )
+        finally:
+            heartbeat.stop()
+            if current_module:
+                current_module.close()
+            if heartbeat.lost:
+                # the job was put back into the queue, the consumer claiming it again queues the next stages
+                self.statuslog.warning('Process %s lost the lease of job %s' % (self.process_name, job.job_id))
+            elif job.payload['module'] == 'download-many':
+                # the following jobs are queued per body as if each body was downloaded alone
+                for body_id in getattr(current_module, 'bodies_done', []):
+                    self.add_next_to_queue('download', **dict(job.payload, body=body_id))
+                job.complete()
+            else:
+                self.add_next_to_queue(job.payload['module'], **job.payload)
+                job.complete()
+            setproctitle('%s worker: idle ' % self.config.PROJECT_NAME)
+
     def graceful_shutdown(self):
+        close_connections()
         print("Shutdown of %s complete!" % self.process_name)
 
     def init_queue(self):
-        try:
-            db_raw_client = pymongo.MongoClient(
-                host=self.config.MONGO_DB_HOST,
-                port=self.config.MONGO_DB_PORT,
-                connect=False
-            )
-            db_raw_client.server_info()
-        except pymongo.errors.ServerSelectionTimeoutError as err:
-            sys.exit('fatal: connection to MongoDB can\'t be established.')
-        db_raw = db_raw_client[self.config.MONGO_DB_NAME]
+        # the queue shares the connection of this process with all tasks it runs
+        db_raw_client, db_raw = get_mongodb(self.config)
+        # every worker has its own consumer id, so only the worker holding a job can renew or complete it
+        consumer_id = '%s:%s' % (socket.gethostname(), self.process_name)
         # Queue (Netzwerk)
         self.queue_network = MongoQueue(
             db_raw.queue_network,
-            consumer_id="main",
-            timeout=300,
-            max_attempts=3
+            notifications=db_raw.queue_network_events,
+            consumer_id=consumer_id,
+            timeout=self.config.QUEUE_LEASE_TIME,
+            max_attempts=3,
+            max_per_external=self.config.QUEUE_HOST_MAX_JOBS,
+            unique_keys=['module', 'body'],
+            min_keys=['since'],
+            match_keys=['nonext']
+        )
+        # Queue (Lokal)
+        self.queue_local = MongoQueue(
+            db_raw.queue_local,
+            notifications=db_raw.queue_local_events,
+            consumer_id=consumer_id,
+            timeout=self.config.QUEUE_LEASE_TIME,
+            max_attempts=3,
+            unique_keys=['module', 'body'],
+            min_keys=['since'],
+            match_keys=['nonext']
+        )
+        self.pipeline = Pipeline(
+            db_raw.pipeline_runs,
+            self.put_job,
+            processing=self.config.ENABLE_PROCESSING
         )
 
     def add_next_to_queue(self, current_module, **kwargs):
         if 'nonext' in kwargs:
             return
-        if current_module in self.next_job.keys():
-            for next_module in self.next_job[current_module]:
-                kwargs['module'] = next_module
-                self.queue_network.put(kwargs)
+        self.pipeline.complete(current_module, kwargs)
+
+    def get_queue(self, module):
+        # CPU bound jobs go to the local pool, everything waiting on the network to the network pool
+        if module in self.config.QUEUE_LOCAL_MODULES:
+            return self.queue_local
+        return self.queue_network
+
+    def put_job(self, payload):
+        external = None
+        if payload['module'] in self.config.QUEUE_HOST_MODULES:
+            external = self.get_external(payload.get('body'))
+        return self.get_queue(payload['module']).put(payload, external=external)
+
+    def get_external(self, body_id):
+        """
+        The address of the body's RIS host, which limits the jobs running against one host at the same time.
+        """
+        for filename in os.listdir(self.config.BODY_DIR):
+            if not body_id or not filename.startswith(body_id) or filename[-4:] != '.yml':
+                continue
+            with open(os.path.join(self.config.BODY_DIR, filename)) as body_config_file:
+                body_config = yaml.load(body_config_file, Loader=yaml.SafeLoader)
+            if body_config and body_config.get('url'):
+                return get_host_address(body_config['url'], self.config.QUEUE_HOST_CACHE_TIME)
+        return None
 
     def load_config(self):
         self.config = get_config(os.getenv('APPLICATION_MODE', 'DEVELOPMENT'))()